@@ -0,0 +1,98 @@
+'''
+Check and benchmark of the boundary tracer against contouring on a synthetic system.
+
+For every pair of polymorphs of the first substance type, the boundary is drawn with ``method: contour`` and
+with ``method: trace``. The longest contour line must be followed by a single traced line: every vertex of
+either must lie within ``--max-distance`` grid steps of the other. Tracing needs smooth energies, so the tables
+use bilinear interpolation by default; with ``--interpolation nearest`` both methods contour.
+
+The polymorphs share the axes of their tables unless ``--separate-axes`` is given.
+
+    $ python3 benchmarks/boundary_trace.py --interpolation bicubic --p-step 1 --t-step 10
+'''
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'phdg'))
+
+from abstract import System
+from phase import PhaseDiagramPlotter
+from plotters import new_figure
+
+from synthetic import make_config
+
+def distance(a: numpy.ndarray, b: numpy.ndarray, scale: numpy.ndarray) -> float:
+    '''
+    Largest distance (in grid steps) from a vertex of ``a`` to the vertices of ``b``
+    '''
+    if len(a) == 0 or len(b) == 0: return 0 if len(a) == len(b) else numpy.inf
+    return numpy.max(numpy.min(numpy.linalg.norm((a[:, None, :] - b[None, :, :]) / scale, axis=-1), axis=1))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--polymorphs', type=int, default=6)
+    parser.add_argument('--interpolation', default='bilinear')
+    parser.add_argument('--p-step', type=float, default=1)
+    parser.add_argument('--t-step', type=float, default=10)
+    parser.add_argument('--max-distance', type=float, default=2)
+    parser.add_argument('--separate-axes', action='store_true', help='tables of the polymorphs on different grids')
+    args = parser.parse_args()
+
+    plotter = PhaseDiagramPlotter()
+    scale = numpy.array([args.p_step, args.t_step])
+    failures = 0
+
+    with tempfile.TemporaryDirectory() as directory:
+        system = System(make_config(directory, 2, args.polymorphs, interpolation=args.interpolation, shared_axes=not args.separate_axes))
+        system.get_evaluator()
+
+        names = [ substance.substance_name for substance in system.find_substances_by_type('T0') ]
+
+        for i in range(len(names)):
+            for j in range(i + 1, len(names)):
+                substances = [ system.find_substances_by_type('T0')[k] for k in (i, j) ]
+                p_range = (max(s.get_pressure_range()[0] for s in substances), min(s.get_pressure_range()[1] for s in substances))
+                t_range = (max(s.get_temperature_range()[0] for s in substances), min(s.get_temperature_range()[1] for s in substances))
+                if p_range[1] - p_range[0] < 10 * args.p_step or t_range[1] - t_range[0] < 10 * args.t_step: continue
+
+                boundary_options = {
+                    'combinations': [ [['T0', names[i]]], [['T0', names[j]]] ],
+                    'p_range': p_range, 'p_step': args.p_step, 't_range': t_range, 't_step': args.t_step
+                }
+
+                polylines, times = {}, {}
+                for method in ('contour', 'trace'):
+                    ax = new_figure().add_subplot()
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        start = time.perf_counter()
+                        polylines[method] = plotter.plot_boundary(ax, system, dict(boundary_options, method=method))
+                        times[method] = time.perf_counter() - start
+
+                if len(polylines['contour']) == 0 and len(polylines['trace']) == 0: continue
+
+                contour = max(polylines['contour'], key=len, default=numpy.empty((0, 2)))
+                contours = numpy.concatenate(polylines['contour']) if polylines['contour'] else numpy.empty((0, 2))
+                trace = min(polylines['trace'], key=lambda polyline: distance(contour, polyline, scale), default=numpy.empty((0, 2)))
+                error = max(distance(contour, trace, scale), distance(trace, contours, scale))
+                failures += error > args.max_distance
+
+                print("{} / {}: contour {} lines, longest {} points, {:.3f} s; trace {} lines, matching {} points, {:.3f} s; distance {:.2f} steps{}".format(
+                    names[i], names[j],
+                    len(polylines['contour']), len(contour), times['contour'],
+                    len(polylines['trace']), len(trace), times['trace'],
+                    error, '' if error <= args.max_distance else '  MISMATCH'
+                ))
+
+    if failures > 0:
+        raise RuntimeError("{} boundaries differ between tracing and contouring".format(failures))
+
+if __name__ == '__main__':
+    main()
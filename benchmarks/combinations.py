@@ -0,0 +1,90 @@
+'''
+Benchmark of the combination enumeration on synthetic systems.
+
+Every substance gets a tiny table (the enumeration only looks at the axes), spread over random, partially
+overlapping P/T windows. The pruned enumeration of ``System.find_combinations_by_manifest`` is compared with
+the full ``itertools.product`` filtered by ``Combination.is_valid_range``, and both must give the same
+combinations in the same order.
+
+    $ python3 benchmarks/combinations.py --types 4 --polymorphs 12 --components 4
+'''
+
+import argparse
+import itertools
+import os
+import sys
+import tempfile
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'phdg'))
+
+from abstract import Combination, System
+
+def write_table(fname: str, p_range: tuple, t_range: tuple):
+    p = numpy.linspace(*p_range, 3)
+    t = numpy.linspace(*t_range, 3)
+    with open(fname, 'w') as fp:
+        fp.write('T\\P ' + ' '.join('%.6f' % x for x in p) + '\n')
+        numpy.savetxt(fp, numpy.column_stack([t, numpy.zeros((len(t), len(p)))]), fmt='%.6f')
+
+def make_config(directory: str, num_types: int, num_polymorphs: int, num_components: int, seed: int = 0) -> dict:
+    rng = numpy.random.default_rng(seed)
+    substances = []
+    for i in range(num_types):
+        for j in range(num_polymorphs):
+            p_min = rng.uniform(0, 300)
+            t_min = rng.uniform(0, 3000)
+            fname = os.path.join(directory, 'S%d-%d.txt' % (i, j))
+            write_table(fname, (p_min, p_min + rng.uniform(10, 80)), (t_min, t_min + rng.uniform(300, 1500)))
+            substances.append({ 'name': 'S%d-%d' % (i, j), 'type': 'T%d' % i, 'gibbs_dir': fname, 'num_formula_units': 1 })
+    manifests = [
+        [ [1, 'T%d' % ((i + k) % num_types)] for k in range(num_components) ]
+        for i in range(num_types)
+    ]
+    return { 'system': { 'substances': substances, 'manifests': manifests } }
+
+def find_combinations_by_product(system: System, manifest: list):
+    for combination in itertools.product(*(
+        system.find_substances_by_type(substance_spec[1])
+        for substance_spec in manifest
+    )):
+        combination = Combination(list(zip((s[0] for s in manifest), combination)))
+        if combination.is_valid_range():
+            yield combination
+
+def describe(combinations: list) -> list:
+    return [ [ (s[0], s[1].substance_name) for s in combination.substances ] for combination in combinations ]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--types', type=int, default=4)
+    parser.add_argument('--polymorphs', type=int, default=12)
+    parser.add_argument('--components', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        system = System(make_config(directory, args.types, args.polymorphs, args.components, args.seed))
+
+        start = time.perf_counter()
+        product = [ c for manifest in system.substance_manifests for c in find_combinations_by_product(system, manifest) ]
+        product_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        pruned = system.find_combinations()
+        pruned_time = time.perf_counter() - start
+
+    if describe(product) != describe(pruned):
+        raise RuntimeError("The pruned enumeration differs from the full product")
+
+    print("{} types x {} polymorphs, {} components: {} candidates, {} combinations".format(
+        args.types, args.polymorphs, args.components,
+        args.types * args.polymorphs ** args.components, len(pruned)
+    ))
+    print("product: {:.3f} s".format(product_time))
+    print("pruned:  {:.3f} s ({:.1f}x)".format(pruned_time, product_time / pruned_time))
+
+if __name__ == '__main__':
+    main()
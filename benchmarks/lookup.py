@@ -0,0 +1,76 @@
+'''
+Benchmark of the nearest-node lookup of ``GibbsFreeEnergyGrid.g_pt``.
+
+The original lookup, a ``numpy.vectorize`` over two ``argmin(abs(axis - x))`` scans per point, is compared with
+the batched ``AxisIndex`` lookup on a uniform and on a non-uniform table. Points include nodes, midpoints
+(ties) and coordinates outside the table, and both lookups must return identical arrays.
+
+    $ python3 benchmarks/lookup.py --nodes 300 --points 100000
+'''
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'phdg'))
+
+from gibbs import GibbsFreeEnergyGrid
+
+def vectorized_g_pt(grid: GibbsFreeEnergyGrid, p, t):
+    def _g_pt(p, t):
+        return grid.gibbs_free_energies[
+            numpy.argmin(numpy.abs(numpy.array(grid.temperature_array) - t)),
+            numpy.argmin(numpy.abs(numpy.array(grid.pressure_array) - p))
+        ]
+    return numpy.vectorize(_g_pt)(p, t)
+
+def make_points(axis: numpy.ndarray, num_points: int, rng) -> numpy.ndarray:
+    span = axis.max() - axis.min()
+    return numpy.concatenate([
+        rng.choice(axis, num_points // 4),
+        rng.choice((axis[1:] + axis[:-1]) / 2, num_points // 4),
+        rng.uniform(axis.min() - .1 * span, axis.max() + .1 * span, num_points - 2 * (num_points // 4))
+    ])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--nodes', type=int, default=300)
+    parser.add_argument('--points', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = numpy.random.default_rng(args.seed)
+
+    axes = {
+        'uniform': (numpy.linspace(0, 300, args.nodes), numpy.linspace(0, 3000, args.nodes)),
+        'non-uniform': (numpy.sort(rng.uniform(0, 300, args.nodes)), numpy.sort(rng.uniform(0, 3000, args.nodes)))
+    }
+
+    for name, (p_axis, t_axis) in axes.items():
+        grid = GibbsFreeEnergyGrid(p_axis, t_axis, rng.normal(size=(len(t_axis), len(p_axis))))
+        p = make_points(p_axis, args.points, rng)
+        t = rng.permutation(make_points(t_axis, args.points, rng))
+
+        start = time.perf_counter()
+        expected = vectorized_g_pt(grid, p, t)
+        vectorized_time = time.perf_counter() - start
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = grid.g_pt(p, t)
+            batched_time = time.perf_counter() - start
+
+        if not numpy.array_equal(expected, result):
+            raise RuntimeError("The batched lookup differs from numpy.vectorize on the {} table".format(name))
+
+        print("{}: {} x {} table, {} points".format(name, args.nodes, args.nodes, len(p)))
+        print("  vectorize: {:.3f} s".format(vectorized_time))
+        print("  batched:   {:.4f} s ({:.0f}x)".format(batched_time, vectorized_time / batched_time))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+'''
+Parse throughput of the Gibbs free energy table reader backends on a synthetic table.
+
+A ``rows`` x ``columns`` table is written to a temporary file (10k x 10k by default, about 1.2 GB of text) and
+parsed with every backend of ``GibbsFreeEnergyGridTableReader``, recording the time and the peak of the
+memory allocated while parsing. All the backends must give identical arrays.
+
+    $ python3 benchmarks/parse.py --rows 10000 --columns 10000
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'phdg'))
+
+from reader import GibbsFreeEnergyGridTableReader
+
+def write_table(fname: str, num_rows: int, num_columns: int, seed: int = 0):
+    rng = numpy.random.default_rng(seed)
+    with open(fname, 'w') as fp:
+        fp.write('T\\P ' + ' '.join('%.6f' % x for x in numpy.linspace(0, 300, num_columns)) + '\n')
+        t = numpy.linspace(0, 3000, num_rows)
+        for start in range(0, num_rows, 1000):
+            stop = min(start + 1000, num_rows)
+            block = numpy.column_stack([t[start:stop], rng.normal(-1000, 100, (stop - start, num_columns))])
+            numpy.savetxt(fp, block, fmt='%.10f')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--columns', type=int, default=10000)
+    parser.add_argument('--backends', nargs='+', default=list(GibbsFreeEnergyGridTableReader.BACKENDS), choices=GibbsFreeEnergyGridTableReader.BACKENDS)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        fname = os.path.join(directory, 'table.txt')
+        write_table(fname, args.rows, args.columns)
+        size = os.path.getsize(fname)
+
+        print("{} x {} table, {:.1f} MiB of text".format(args.rows, args.columns, size / (1 << 20)))
+
+        reference = None
+        for backend in args.backends:
+            reader = GibbsFreeEnergyGridTableReader(backend=backend)
+            tracemalloc.start()
+            start = time.perf_counter()
+            table = reader.parse_table(fname)
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            if reference is None:
+                reference = table
+            elif not all(numpy.array_equal(a, b) for a, b in zip(reference, table)):
+                raise RuntimeError("Backend {} disagrees with {}".format(backend, args.backends[0]))
+
+            print("{:>10}: {:.2f} s, {:.1f} MiB/s, peak {:.1f} MiB (table {:.1f} MiB)".format(
+                backend, elapsed, size / (1 << 20) / elapsed, peak / (1 << 20), table[2].nbytes / (1 << 20)
+            ))
+            del table
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+'''
+Benchmark of the phase diagram engines on a synthetic system.
+
+The stable combinations are computed with the ``patch`` engine and with the ``global`` engine (uniform and
+adaptive refinement) of ``PhaseDiagramPlotter``; the uniform global engine must give exactly the same grid as
+the patch engine.
+
+    $ python3 benchmarks/phase_engines.py --types 4 --polymorphs 6 --p-step 1 --t-step 10
+'''
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'phdg'))
+
+from abstract import System
+from phase import PhaseDiagramPlotter
+
+from synthetic import make_config
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--types', type=int, default=4)
+    parser.add_argument('--polymorphs', type=int, default=6)
+    parser.add_argument('--p-step', type=float, default=1)
+    parser.add_argument('--t-step', type=float, default=10)
+    args = parser.parse_args()
+
+    plotter = PhaseDiagramPlotter()
+
+    with tempfile.TemporaryDirectory() as directory:
+        system = System(make_config(directory, args.types, args.polymorphs))
+        combinations = system.find_combinations()
+
+        # Load the tables before timing
+        system.get_evaluator()
+
+        engines = {
+            'patch': { 'engine': 'patch' },
+            'global': { 'engine': 'global' },
+            'adaptive': { 'engine': 'global', 'refinement': 'adaptive' }
+        }
+
+        grids = {}
+        for name, engine_options in engines.items():
+            options = plotter._load_kwargs(dict(engine_options, p_step=args.p_step, t_step=args.t_step))
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                grids[name] = plotter.fill(system, combinations, options)
+                elapsed = time.perf_counter() - start
+            print("{:>8}: {:.3f} s".format(name, elapsed))
+
+    if not numpy.array_equal(grids['patch'], grids['global']):
+        raise RuntimeError("The global engine differs from the patch engine")
+
+    print("{} combinations, {} x {} grid, adaptive differs at {} nodes".format(
+        len(combinations), *grids['global'].shape, numpy.count_nonzero(grids['adaptive'] != grids['global'])
+    ))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+'''
+Benchmark of the P/T range queries of substances and combinations on a synthetic system.
+
+The ranges used to be recomputed with ``numpy.min``/``numpy.max`` over the axes of every substance on every
+call; they are now computed once. The workload mimics the patch loop of the phase diagram: the ranges of every
+combination are queried once per patch, and every combination is checked with ``is_valid_range``. Both ways
+must give the same ranges.
+
+    $ python3 benchmarks/ranges.py --types 4 --polymorphs 10 --patches 50
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'phdg'))
+
+from abstract import System
+
+def write_table(fname: str, p_range: tuple, t_range: tuple, num_nodes: int):
+    p = numpy.linspace(*p_range, num_nodes)
+    t = numpy.linspace(*t_range, num_nodes)
+    with open(fname, 'w') as fp:
+        fp.write('T\\P ' + ' '.join('%.6f' % x for x in p) + '\n')
+        numpy.savetxt(fp, numpy.column_stack([t, numpy.zeros((len(t), len(p)))]), fmt='%.6f')
+
+def make_config(directory: str, num_types: int, num_polymorphs: int, num_nodes: int, seed: int = 0) -> dict:
+    rng = numpy.random.default_rng(seed)
+    substances = []
+    for i in range(num_types):
+        for j in range(num_polymorphs):
+            p_min = rng.uniform(-5, 100)
+            t_min = rng.choice([0, 300])
+            fname = os.path.join(directory, 'S%d-%d.txt' % (i, j))
+            write_table(fname, (p_min, p_min + rng.uniform(100, 300)), (t_min, t_min + rng.uniform(1500, 3000)), num_nodes)
+            substances.append({ 'name': 'S%d-%d' % (i, j), 'type': 'T%d' % i, 'gibbs_dir': fname, 'num_formula_units': 1 })
+    manifests = [ [ [1, 'T%d' % i], [1, 'T%d' % ((i + 1) % num_types)] ] for i in range(num_types) ]
+    return { 'system': { 'substances': substances, 'manifests': manifests } }
+
+def recomputed_ranges(combination) -> tuple:
+    # Ranges as they used to be computed, from the axes on every call
+    return (
+        (
+            numpy.max([ numpy.min(s[1].pressure_array) for s in combination.substances ]),
+            numpy.min([ numpy.max(s[1].pressure_array) for s in combination.substances ])
+        ),
+        (
+            numpy.max([ numpy.min(s[1].temperature_array) for s in combination.substances ]),
+            numpy.min([ numpy.max(s[1].temperature_array) for s in combination.substances ])
+        )
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--types', type=int, default=4)
+    parser.add_argument('--polymorphs', type=int, default=10)
+    parser.add_argument('--nodes', type=int, default=300, help='nodes per table axis')
+    parser.add_argument('--patches', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        system = System(make_config(directory, args.types, args.polymorphs, args.nodes))
+        combinations = system.find_combinations()
+
+        start = time.perf_counter()
+        for _ in range(args.patches):
+            recomputed = [ recomputed_ranges(combination) for combination in combinations ]
+        recomputed_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(args.patches):
+            stored = [
+                (combination.get_pressure_range(), combination.get_temperature_range())
+                for combination in combinations if combination.is_valid_range()
+            ]
+        stored_time = time.perf_counter() - start
+
+    if recomputed != stored:
+        raise RuntimeError("The stored ranges differ from the recomputed ones")
+
+    print("{} combinations, {} patches".format(len(combinations), args.patches))
+    print("recomputed: {:.3f} s".format(recomputed_time))
+    print("stored:     {:.4f} s ({:.0f}x)".format(stored_time, recomputed_time / stored_time))
+
+if __name__ == '__main__':
+    main()
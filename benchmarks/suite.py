@@ -0,0 +1,192 @@
+'''
+Benchmark suite of the hot paths of phdg, with baselines to detect regressions.
+
+On a synthetic system (see ``synthetic.py``) of the chosen ``--size``, every case is timed (best of
+``--repeat`` runs) and its peak memory measured (allocations traced by ``tracemalloc`` during one more run):
+
+- ``parse/*``: parsing the largest table, with each reader backend;
+- ``lookup/*``: ``GibbsFreeEnergyGrid.g_pt`` at random points, with each interpolation mode;
+- ``combination``: ``Combination.get_gibbs_free_energy_unsafe`` of every combination over its range;
+- ``find_combinations``: ``System.find_combinations`` from scratch;
+- ``phase_map/*``: the stable combinations of a phase diagram, with each engine;
+- ``render``: ``PhaseDiagramPlotter.plot``, including the phase map and writing the PNG.
+
+The tables are read and the combinations enumerated before the timing of the cases that do not measure them.
+``--save FILE`` writes the results as a JSON baseline; ``--compare FILE`` checks them against one and exits
+with an error when a case got slower, or needs more memory, by more than ``--tolerance`` (time differences under
+a millisecond, within the noise of the shortest cases, are not counted).
+
+    $ python3 benchmarks/suite.py --size small --save baseline.json
+    $ python3 benchmarks/suite.py --size small --compare baseline.json
+'''
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'phdg'))
+
+from abstract import System
+from phase import PhaseDiagramPlotter
+from reader import GibbsFreeEnergyGridTableReader
+
+from synthetic import make_config
+
+# Substance types, polymorphs per type, table nodes along P and T, and lookup points
+SIZES = {
+    'small': { 'types': 3, 'polymorphs': 4, 'p_nodes': 61, 't_nodes': 31, 'points': 100000, 'p_step': 2, 't_step': 20 },
+    'medium': { 'types': 4, 'polymorphs': 6, 'p_nodes': 301, 't_nodes': 151, 'points': 1000000, 'p_step': 1, 't_step': 10 },
+    'large': { 'types': 6, 'polymorphs': 10, 'p_nodes': 1001, 't_nodes': 501, 'points': 4000000, 'p_step': .5, 't_step': 5 }
+}
+
+def measure(run, repeat: int) -> dict:
+    '''
+    Best time of ``repeat`` calls of ``run``, and the peak of the memory allocated during one more call
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return { 'time': min(times), 'peak_memory': peak }
+
+def make_cases(system: System, size: dict, directory: str, seed: int) -> dict:
+    '''
+    The benchmark cases on ``system``, as functions to call
+    '''
+    rng = numpy.random.default_rng(seed)
+    cases = {}
+
+    fname = max((substance.gibbs_free_energy_fname for substance in system.substances), key=os.path.getsize)
+    for backend in GibbsFreeEnergyGridTableReader.BACKENDS:
+        cases['parse/' + backend] = lambda backend=backend: GibbsFreeEnergyGridTableReader(backend=backend).parse_table(fname)
+
+    substance = system.substances[0]
+    p_range, t_range = substance.get_pressure_range(), substance.get_temperature_range()
+    p = rng.uniform(*p_range, size['points'])
+    t = rng.uniform(*t_range, size['points'])
+    for interpolation in ('nearest', 'bilinear', 'bicubic'):
+        grid = GibbsFreeEnergyGridTableReader().read_gibbs_free_energy(substance.gibbs_free_energy_fname, interpolation)
+        # Built on first use
+        grid.g_pt(p[:1], t[:1])
+        cases['lookup/' + interpolation] = lambda grid=grid: grid.g_pt(p, t)
+
+    combinations = system.find_combinations()
+    points = []
+    for combination in combinations:
+        n = size['points'] // max(len(combinations), 1)
+        points.append((combination, rng.uniform(*combination.get_pressure_range(), n), rng.uniform(*combination.get_temperature_range(), n)))
+    cases['combination'] = lambda: [ combination.get_gibbs_free_energy_unsafe(P, T) for combination, P, T in points ]
+
+    def find_combinations():
+        system._combinations = None
+        system._interval_indices = {}
+        system.find_combinations()
+    cases['find_combinations'] = find_combinations
+
+    plotter = PhaseDiagramPlotter()
+    diagram = { 'p_step': size['p_step'], 't_step': size['t_step'] }
+    engines = {
+        'global': { 'engine': 'global' },
+        'adaptive': { 'engine': 'global', 'refinement': 'adaptive' },
+        'tiled': { 'engine': 'global', 'tile_size': 128 },
+        'patch': { 'engine': 'patch' }
+    }
+    for name, engine_options in engines.items():
+        options = plotter._load_kwargs(dict(diagram, **engine_options))
+        cases['phase_map/' + name] = lambda options=options: plotter.fill(system, system.find_combinations(), options)
+
+    output = os.path.join(directory, 'phase.png')
+    cases['render'] = lambda: plotter.plot(system, output, **diagram)
+
+    return cases
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    '''
+    Print the results next to the ``baseline`` and return the regressions
+    '''
+    regressions = []
+    print('{:<20}  {:>10}  {:>10}  {:>7}  {:>10}  {:>10}  {:>7}'.format('case', 'time/s', 'base/s', 'ratio', 'peak/MiB', 'base/MiB', 'ratio'))
+    for name, result in results.items():
+        base = baseline['results'].get(name)
+        if base is None:
+            print('{:<20}  {:>10.4f}  {:>10}  {:>7}  {:>10.2f}  {:>10}  {:>7}'.format(name, result['time'], '-', '-', result['peak_memory'] / (1 << 20), '-', '-'))
+            continue
+        time_ratio = result['time'] / base['time'] if base['time'] > 0 else 1.
+        memory_ratio = result['peak_memory'] / base['peak_memory'] if base['peak_memory'] > 0 else 1.
+        print('{:<20}  {:>10.4f}  {:>10.4f}  {:>7.2f}  {:>10.2f}  {:>10.2f}  {:>7.2f}'.format(
+            name, result['time'], base['time'], time_ratio,
+            result['peak_memory'] / (1 << 20), base['peak_memory'] / (1 << 20), memory_ratio
+        ))
+        if time_ratio > 1 + tolerance and result['time'] - base['time'] > 1e-3: regressions.append('{} is {:.2f} times slower'.format(name, time_ratio))
+        if memory_ratio > 1 + tolerance: regressions.append('{} needs {:.2f} times more memory'.format(name, memory_ratio))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', choices=SIZES.keys(), default='small')
+    parser.add_argument('--interpolation', default='nearest', help='interpolation of the system tables (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cases', nargs='+', default=None, help='run only the cases starting with one of these')
+    parser.add_argument('--save', metavar='FILE', help='write the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results with a JSON baseline')
+    parser.add_argument('--tolerance', type=float, default=.25, help='allowed relative increase of the time and the peak memory (default: %(default)s)')
+    args = parser.parse_args()
+
+    size = SIZES[args.size]
+    meta = {
+        'size': args.size, 'interpolation': args.interpolation, 'seed': args.seed,
+        'python': platform.python_version(), 'numpy': numpy.__version__, 'machine': platform.machine()
+    }
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        for key in ('size', 'interpolation', 'seed'):
+            if baseline['meta'][key] != meta[key]:
+                raise RuntimeError("The baseline was made with {} {}, not {}".format(key, baseline['meta'][key], meta[key]))
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        with contextlib.redirect_stdout(io.StringIO()):
+            system = System(make_config(
+                directory, size['types'], size['polymorphs'], size['p_nodes'], size['t_nodes'], args.seed, args.interpolation
+            ))
+            system.get_evaluator()
+            cases = make_cases(system, size, directory, args.seed)
+
+        for name, run in cases.items():
+            if args.cases is not None and not any(name.startswith(prefix) for prefix in args.cases): continue
+            with contextlib.redirect_stdout(io.StringIO()):
+                results[name] = measure(run, args.repeat)
+            if baseline is None:
+                print('{:<20}  {:>10.4f} s  {:>10.2f} MiB'.format(name, results[name]['time'], results[name]['peak_memory'] / (1 << 20)))
+
+    if args.save is not None:
+        with open(args.save, 'w') as fp:
+            json.dump({ 'meta': meta, 'results': results }, fp, indent=1)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            raise RuntimeError("Regressions against {}:\n{}".format(args.compare, '\n'.join(' - ' + r for r in regressions)))
+
+if __name__ == '__main__':
+    main()
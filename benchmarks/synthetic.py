@@ -0,0 +1,50 @@
+'''
+Synthetic systems for the benchmarks.
+
+Every substance gets a table over its own random P/T window, with a smooth Gibbs free energy
+``a + b P - c T - d T^2 + e P T`` of random coefficients, so that the phase diagrams have several stable regions
+with curved boundaries. ``num_types`` substance types of ``num_polymorphs`` polymorphs each are combined by
+pairs of neighbouring types and by single types. With ``shared_axes`` the polymorphs of a type share the axes of
+their tables, as when they are computed on the same P/T grid.
+'''
+
+import os
+
+import numpy
+
+def write_table(fname: str, p_array: numpy.ndarray, t_array: numpy.ndarray, gibbs_free_energies: numpy.ndarray):
+    with open(fname, 'w') as fp:
+        fp.write('T\\P ' + ' '.join('%.6f' % x for x in p_array) + '\n')
+        numpy.savetxt(fp, numpy.column_stack([t_array, gibbs_free_energies]), fmt='%.10f')
+
+def make_config(directory: str, num_types: int = 4, num_polymorphs: int = 6, num_p: int = 61, num_t: int = 31, seed: int = 0, interpolation: str = 'nearest', shared_axes: bool = False) -> dict:
+    '''
+    Write the tables of a synthetic system into ``directory`` and return its configuration (the ``system``
+    block of an input file, with absolute table paths).
+    '''
+    rng = numpy.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    substances = []
+    for i in range(num_types):
+        for j in range(num_polymorphs):
+            p_min = rng.uniform(-5, 150)
+            t_min = rng.choice([0, 300])
+            if j == 0 or not shared_axes:
+                p_array = numpy.linspace(p_min, p_min + rng.uniform(80, 300), num_p)
+                t_array = numpy.linspace(t_min, t_min + rng.uniform(1500, 3000), num_t)
+            P, T = numpy.meshgrid(p_array, t_array)
+            a, b, c = rng.normal(0, 5), rng.uniform(0.3, 1), rng.uniform(0.005, 0.015)
+            G = a + b * P - c * T - 1e-5 * T ** 2 + rng.normal(0, 1e-3) * P * T / 10
+            name = 'S%d-%d' % (i, j)
+            fname = os.path.join(os.path.abspath(directory), name + '.txt')
+            write_table(fname, p_array, t_array, G)
+            substances.append({
+                'name': name, 'type': 'T%d' % i, 'gibbs_dir': fname, 'num_formula_units': 1,
+                'interpolation': interpolation
+            })
+    manifests = [
+        [ [1, 'T%d' % i], [1, 'T%d' % ((i + 1) % num_types)] ] for i in range(num_types)
+    ] + [
+        [ [2, 'T%d' % i] ] for i in range(num_types)
+    ]
+    return { 'system': { 'substances': substances, 'manifests': manifests } }
@@ -1,24 +1,76 @@
 from gibbs import GibbsFreeEnergyGrid
 from reader import GibbsFreeEnergyGridTableReader
-from typing import List, Tuple
-import itertools
+from evaluator import GibbsFreeEnergyEvaluator, SubstanceEnergyTable
+from phasemap import PhaseMap
+from instrument import get_logger, profiler
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+import bisect
+import threading
 import numpy
 
+logger = get_logger('abstract')
+
 class Substance:
     '''
     The class represent a certain structure. It holds the name and type and Gibbs free energy for the phase.
+
+    The Gibbs free energy table is read lazily, on the first access to ``gibbs_free_energy``; until then only its
+    pressure and temperature axes are known, which is enough for the range queries. The ranges are computed
+    once, when the axes are read.
     '''
+    __slots__ = (
+        'substance_type', 'substance_name', 'gibbs_free_energy_num_formula_units',
+        'gibbs_free_energy_fname', 'gibbs_free_energy_interpolation', 'pressure_array', 'temperature_array',
+        '_reader', '_gibbs_free_energy', '_lock', '_pressure_range', '_temperature_range'
+    )
+
     substance_type: str
     substance_name: str
-    gibbs_free_energy: GibbsFreeEnergyGrid
     gibbs_free_energy_num_formula_units: float
+    gibbs_free_energy_fname: str
+    gibbs_free_energy_interpolation: str
+    pressure_array: numpy.ndarray
+    temperature_array: numpy.ndarray
 
-    def __init__(self, substance_name: str, substance_type: str, fname: str, num_formula_units: float):
+    def __init__(self, substance_name: str, substance_type: str, fname: str, num_formula_units: float, interpolation: str = 'nearest', reader: GibbsFreeEnergyGridTableReader = None, lazy: bool = True):
         self.substance_type = substance_type
         self.substance_name = substance_name
-        self.gibbs_free_energy = GibbsFreeEnergyGridTableReader().read_gibbs_free_energy(fname)
         self.gibbs_free_energy_num_formula_units = num_formula_units
-    
+        self.gibbs_free_energy_fname = fname
+        self.gibbs_free_energy_interpolation = interpolation
+        self._reader = reader if reader is not None else GibbsFreeEnergyGridTableReader()
+        self._gibbs_free_energy = None
+        self._lock = threading.Lock()
+        if lazy:
+            self.pressure_array, self.temperature_array = self._reader.load_axes(fname)
+        else:
+            self.pressure_array, self.temperature_array = self.gibbs_free_energy.pressure_array, self.gibbs_free_energy.temperature_array
+        self._pressure_range = (numpy.min(self.pressure_array), numpy.max(self.pressure_array))
+        self._temperature_range = (numpy.min(self.temperature_array), numpy.max(self.temperature_array))
+
+    @property
+    def gibbs_free_energy(self) -> GibbsFreeEnergyGrid:
+        if self._gibbs_free_energy is None:
+            with self._lock:
+                if self._gibbs_free_energy is None:
+                    self._gibbs_free_energy = self._reader.read_gibbs_free_energy(
+                        self.gibbs_free_energy_fname, self.gibbs_free_energy_interpolation
+                    )
+        return self._gibbs_free_energy
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._gibbs_free_energy is not None
+
+    def __getstate__(self):
+        return { name: getattr(self, name) for name in self.__slots__ if name != '_lock' }
+
+    def __setstate__(self, state: dict):
+        for name, value in state.items():
+            setattr(self, name, value)
+        self._lock = threading.Lock()
+
     def __repr__(self):
         return "<Substance {} ({})>".format(
             self.substance_type,
@@ -26,63 +78,61 @@ class Substance:
         )
 
     def get_temperature_range(self) -> Tuple[float]:
-        return (
-            numpy.min(self.gibbs_free_energy.temperature_array),
-            numpy.max(self.gibbs_free_energy.temperature_array)
-        )
+        return self._temperature_range
 
     def get_pressure_range(self) -> Tuple[float]:
-        return (
-            numpy.min(self.gibbs_free_energy.pressure_array),
-            numpy.max(self.gibbs_free_energy.pressure_array)
-        )
-    
+        return self._pressure_range
+
     def get_gibbs_free_energy(self, P, T):
         return self.gibbs_free_energy.g_pt(P, T) / self.gibbs_free_energy_num_formula_units
 
+    def get_volume(self, P, T):
+        return self.gibbs_free_energy.v_pt(P, T) / self.gibbs_free_energy_num_formula_units
+
+    def get_entropy(self, P, T):
+        return self.gibbs_free_energy.s_pt(P, T) / self.gibbs_free_energy_num_formula_units
+
+    def get_enthalpy(self, P, T):
+        return self.gibbs_free_energy.h_pt(P, T) / self.gibbs_free_energy_num_formula_units
+
+    def get_heat_capacity(self, P, T):
+        return self.gibbs_free_energy.cp_pt(P, T) / self.gibbs_free_energy_num_formula_units
+
 class Combination:
     '''
     A helper class that combines several substances.
 
+    The pressure and temperature ranges, the intersection of those of its substances, are computed once when
+    the combination is built.
     '''
+    __slots__ = ('substances', '_pressure_range', '_temperature_range')
+
     substances: List[Tuple[float, Substance]]
 
     def __init__(self, substances):
         self.substances = substances
+        self._pressure_range = (
+            max(substance[1].get_pressure_range()[0] for substance in substances),
+            min(substance[1].get_pressure_range()[1] for substance in substances)
+        )
+        self._temperature_range = (
+            max(substance[1].get_temperature_range()[0] for substance in substances),
+            min(substance[1].get_temperature_range()[1] for substance in substances)
+        )
 
     def get_temperature_range(self) -> Tuple[float]:
-        return (
-            numpy.max([
-                substance[1].get_temperature_range()[0]
-                for substance in self.substances
-            ]),
-            numpy.min([
-                substance[1].get_temperature_range()[1]
-                for substance in self.substances
-            ]) 
-        )
+        return self._temperature_range
 
     def get_pressure_range(self) -> Tuple[float]:
-        return (
-            numpy.max([
-                substance[1].get_pressure_range()[0]
-                for substance in self.substances
-            ]),
-            numpy.min([
-                substance[1].get_pressure_range()[1]
-                for substance in self.substances
-            ]) 
-        )
+        return self._pressure_range
 
     def is_valid_range(self):
-        if numpy.subtract(*self.get_pressure_range()) > 0: return False
-        elif numpy.subtract(*self.get_temperature_range()) > 0: return False
-        else: return True
-            
+        return self._pressure_range[0] <= self._pressure_range[1] and self._temperature_range[0] <= self._temperature_range[1]
+
     def get_gibbs_free_energy(self, P, T):
 
-        p_min, p_max = self.get_pressure_range()
-        t_min, t_max = self.get_temperature_range()
+        p_min, p_max = self._pressure_range
+        t_min, t_max = self._temperature_range
 
         if P > p_min and P < p_max and T > t_min and T < t_max:
             return numpy.sum([
@@ -96,11 +146,82 @@ class Combination:
             substance[0] * substance[1].get_gibbs_free_energy(P, T) for substance in self.substances
         ], axis=0)
 
+    def _sum(self, quantity: str, P, T):
+        return numpy.sum([
+            substance[0] * getattr(substance[1], quantity)(P, T) for substance in self.substances
+        ], axis=0)
+
+    def get_volume(self, P, T):
+        return self._sum('get_volume', P, T)
+
+    def get_entropy(self, P, T):
+        return self._sum('get_entropy', P, T)
+
+    def get_enthalpy(self, P, T):
+        return self._sum('get_enthalpy', P, T)
+
+    def get_heat_capacity(self, P, T):
+        return self._sum('get_heat_capacity', P, T)
+
+    def get_clapeyron_slope(self, other: 'Combination', P, T):
+        '''
+        dP/dT of the boundary with ``other`` at points ``(P, T)`` on it, from the Clausius-Clapeyron relation
+        dP/dT = dS / dV. Only derivatives of the tables are evaluated, not G; the slope is infinite where both
+        sides have the same volume.
+        '''
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return (self.get_entropy(P, T) - other.get_entropy(P, T)) / (self.get_volume(P, T) - other.get_volume(P, T))
+
+    def get_description_key(self) -> tuple:
+        '''
+        The multiset of (type, name) pairs of the substances, as a sorted tuple
+        '''
+        return tuple(sorted((substance[1].substance_type, substance[1].substance_name) for substance in self.substances))
+
+    def matches_description(self, combination_description) -> bool:
+        '''
+        Whether the combination has as many substances as ``combination_description`` and every (type, name)
+        in it is among the types and names of the substances.
+        '''
+        if len(self.substances) != len(combination_description): return False
+        combination_names = [ substance[1].substance_name for substance in self.substances ]
+        combination_types = [ substance[1].substance_type for substance in self.substances ]
+        for substance_description in combination_description:
+            if substance_description[0] not in combination_types or substance_description[1] not in combination_names:
+                return False
+        return True
+
     def __repr__(self):
         return "Combination [{}]".format(
             ", ".join(str(substance) for substance in self.substances)
         )
 
+class SubstanceIntervalIndex:
+    '''
+    The substances of one type sorted by the lower end of their pressure range, to find those overlapping a given
+    P/T window without looking at the others.
+    '''
+
+    substances: List[Substance]
+
+    def __init__(self, substances: List[Substance]):
+        self.substances = list(substances)
+        self._order = sorted(range(len(self.substances)), key=lambda k: self.substances[k].get_pressure_range()[0])
+        self._pressure_lows = [ self.substances[k].get_pressure_range()[0] for k in self._order ]
+
+    def find_overlapping(self, p_range: tuple, t_range: tuple) -> List[Substance]:
+        '''
+        Substances whose (closed) ranges overlap ``p_range`` and ``t_range``, in their original order
+        '''
+        positions = []
+        for k in self._order[:bisect.bisect_right(self._pressure_lows, p_range[1])]:
+            substance = self.substances[k]
+            if substance.get_pressure_range()[1] < p_range[0]: continue
+            t_min, t_max = substance.get_temperature_range()
+            if t_min > t_range[1] or t_max < t_range[0]: continue
+            positions.append(k)
+        return [ self.substances[k] for k in sorted(positions) ]
+
 class System:
     '''
     An Al-O system includes AlOOH or Al2O3 + H2O.
@@ -115,18 +236,86 @@ class System:
     '''
     substances: List[Substance]
     substance_manifests: List[tuple]
+    workers: Optional[int]
+    energy_table: Optional[SubstanceEnergyTable]
+    _combinations: Optional[List[Combination]]
+    _combination_index: dict
+    _interval_indices: dict
 
-    def __init__(self, config):
+    def __init__(self, config, reader: GibbsFreeEnergyGridTableReader = None, workers: Optional[int] = None):
 
-        self.substances = []
-        
-        for substance in config['system']['substances']:
-            self.substances.append(
-                Substance(substance['name'], substance['type'], substance['gibbs_dir'], substance['num_formula_units'])
-            )
+        if workers is None: workers = config['system'].get('workers')
+
+        self.workers = workers
+
+        self.substances = self.load_substances(
+            config['system']['substances'], reader, workers, config['system'].get('lazy', True)
+        )
 
         self.substance_manifests = config['system']['manifests']
 
+        self.energy_table = None
+
+        self._combinations = None
+        self._combination_index = {}
+        self._interval_indices = {}
+
+    @staticmethod
+    def load_substances(substance_specs: List[dict], reader: GibbsFreeEnergyGridTableReader = None, workers: Optional[int] = None, lazy: bool = True) -> List[Substance]:
+        '''
+        Load the substances concurrently with a pool of ``workers`` threads, keeping the order of ``substance_specs``.
+        Every substance is attempted, the failures are reported together. With ``lazy``, only the table axes are
+        read here and the Gibbs free energies on demand.
+        '''
+
+        def load(substance):
+            return Substance(
+                substance['name'], substance['type'], substance['gibbs_dir'], substance['num_formula_units'],
+                substance.get('interpolation', 'nearest'), reader, lazy
+            )
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [ executor.submit(load, substance) for substance in substance_specs ]
+
+        substances = []
+        errors = []
+
+        for substance, future in zip(substance_specs, futures):
+            try:
+                substances.append(future.result())
+            except Exception as e:
+                errors.append(' - {} ({}): {}'.format(substance.get('name'), substance.get('gibbs_dir'), e))
+
+        if len(errors) > 0:
+            raise RuntimeError("Failed to load {} of {} substances:\n{}".format(
+                len(errors), len(substance_specs), '\n'.join(errors)
+            ))
+
+        return substances
+
+    def load_gibbs_free_energies(self, substances: List[Substance]):
+        '''
+        Load the Gibbs free energy tables of the lazy ``substances`` not loaded yet, with the same pool of
+        ``workers`` threads as ``load_substances``; the failures are reported together.
+        '''
+        substances = [ substance for substance in substances if not substance.is_loaded ]
+        if len(substances) == 0: return
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [ executor.submit(lambda substance: substance.gibbs_free_energy, substance) for substance in substances ]
+
+        errors = []
+        for substance, future in zip(substances, futures):
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(' - {} ({}): {}'.format(substance.substance_name, substance.gibbs_free_energy_fname, e))
+
+        if len(errors) > 0:
+            raise RuntimeError("Failed to load {} of {} substances:\n{}".format(
+                len(errors), len(substances), '\n'.join(errors)
+            ))
+
     def find_substances_by_type(self, substance_type: str) -> list:
         '''
         Find substance based on given criterion, criteria could be the combination of the following:
@@ -140,23 +329,125 @@ class System:
             if substance.substance_type == substance_type
         ]
     
+    def get_interval_index(self, substance_type: str) -> SubstanceIntervalIndex:
+        if substance_type not in self._interval_indices:
+            self._interval_indices[substance_type] = SubstanceIntervalIndex(self.find_substances_by_type(substance_type))
+        return self._interval_indices[substance_type]
+
     def find_combinations_by_manifest(self, manifest: List[Tuple[float, str]]):
-        for combination in itertools.product(*(
-            self.find_substances_by_type(substance_spec[1])
-            for substance_spec in manifest
-        )):
-            combination = Combination(list(zip((s[0] for s in manifest), combination)))
-            if combination.is_valid_range():
-                yield combination
+        '''
+        Combinations with one substance per entry of ``manifest`` and a non-empty P/T range, in the order of
+        ``itertools.product`` over the substances of each type. The ranges are intersected while the product is
+        built, so a branch is dropped as soon as its partial intersection is empty.
+        '''
+        coefficients = [ substance_spec[0] for substance_spec in manifest ]
+        indices = [ self.get_interval_index(substance_spec[1]) for substance_spec in manifest ]
+
+        def extend(chosen: list, p_range: tuple, t_range: tuple):
+            if len(chosen) == len(manifest):
+                yield Combination(list(zip(coefficients, chosen)))
+                return
+            for substance in indices[len(chosen)].find_overlapping(p_range, t_range):
+                substance_p_range = substance.get_pressure_range()
+                substance_t_range = substance.get_temperature_range()
+                yield from extend(
+                    chosen + [substance],
+                    (max(p_range[0], substance_p_range[0]), min(p_range[1], substance_p_range[1])),
+                    (max(t_range[0], substance_t_range[0]), min(t_range[1], substance_t_range[1]))
+                )
+
+        yield from extend([], (-numpy.inf, numpy.inf), (-numpy.inf, numpy.inf))
 
     def find_combinations(self) -> List[Combination]:
         '''
-        Find combinations based on given combination manifest
+        Find combinations based on given combination manifest. They are enumerated once, along with an index
+        of their (type, name) multisets, and the same list is returned afterwards.
+        '''
+
+        if self._combinations is None:
+
+            combinations = []
+
+            with profiler.timer('find combinations'):
+                for manifest in self.substance_manifests:
+                    combinations.extend(self.find_combinations_by_manifest(manifest))
+            profiler.count('combinations', len(combinations))
+            logger.info('%d combinations of %d substances', len(combinations), len(self.substances))
+
+            self._combination_index = {}
+            for combination in combinations:
+                self._combination_index.setdefault(combination.get_description_key(), combination)
+
+            self._combinations = combinations
+
+        return self._combinations
+
+    def find_combination_by_description(self, combination_description) -> Optional[Combination]:
+        '''
+        The first combination matching ``combination_description``, a list of (type, name) pairs, or ``None``.
+        An exact match of the pairs is looked up in the index; otherwise the combinations are scanned with the
+        looser ``Combination.matches_description``.
         '''
+        combinations = self.find_combinations()
+        key = tuple(sorted((substance_type, substance_name) for substance_type, substance_name in combination_description))
+        if key in self._combination_index:
+            return self._combination_index[key]
+        return next((
+            combination for combination in combinations
+            if combination.matches_description(combination_description)
+        ), None)
+
+    def get_evaluator(self, combinations: Optional[List[Combination]] = None) -> GibbsFreeEnergyEvaluator:
+        '''
+        An evaluator computing the Gibbs free energies of ``combinations`` (by default all of them) at once,
+        reusing ``energy_table`` when it has been precomputed. The tables of its substances are loaded up front,
+        in parallel.
+        '''
+        evaluator = GibbsFreeEnergyEvaluator(self.find_combinations() if combinations is None else combinations, self.energy_table)
+        self.load_gibbs_free_energies(evaluator.substances)
+        return evaluator
+
+    def query(self, P, T, combinations: Optional[List[Combination]] = None, phase_map: Union[PhaseMap, str, None] = None, chunk_bytes: int = 1 << 26) -> tuple:
+        '''
+        The stable combination at each of the points ``(P, T)`` (arrays of a common shape): its index into
+        ``combinations`` (by default all of them; -1 where none is in range), its Gibbs free energy and the
+        margin to the runner-up (see ``GibbsFreeEnergyEvaluator.rank``), each shaped like the points.
+
+        The points are evaluated in chunks whose energies take about ``chunk_bytes``, whatever their number.
+        With a ``phase_map`` (or the path of one) computed for the same combinations, the answers are read off
+        its nearest nodes instead, see ``PhaseMap.query``.
+        '''
+        return next(self.iter_query([(P, T)], combinations, phase_map, chunk_bytes))
+
+    def iter_query(self, chunks: Iterable[tuple], combinations: Optional[List[Combination]] = None, phase_map: Union[PhaseMap, str, None] = None, chunk_bytes: int = 1 << 26) -> Iterator[tuple]:
+        '''
+        ``query`` over a stream of ``(P, T)`` chunks, for points that do not fit in memory at once; the
+        evaluator (or the phase map) is set up once for all of them.
+        '''
+        combinations = self.find_combinations() if combinations is None else combinations
+
+        if phase_map is not None:
+            if isinstance(phase_map, str): phase_map = PhaseMap.load(phase_map)
+            if not phase_map.matches(combinations):
+                raise RuntimeError("The combinations of the phase map differ from those queried")
+            evaluator = None
+        else:
+            evaluator = self.get_evaluator(combinations)
 
-        combinations = []
+        size = max(1, chunk_bytes // (8 * max(len(combinations), 1)))
 
-        for manifest in self.substance_manifests:
-            combinations.extend(self.find_combinations_by_manifest(manifest))
-        
-        return combinations
+        for P, T in chunks:
+            P, T = numpy.broadcast_arrays(numpy.asarray(P, dtype='float64'), numpy.asarray(T, dtype='float64'))
+            P_flat, T_flat = P.ravel(), T.ravel()
+            C = numpy.empty(P_flat.shape, dtype=int)
+            G = numpy.empty(P_flat.shape)
+            margin = numpy.empty(P_flat.shape)
+            for start in range(0, len(P_flat), size):
+                points = slice(start, start + size)
+                if evaluator is None:
+                    C[points], G[points], margin[points] = phase_map.query(P_flat[points], T_flat[points])
+                else:
+                    C[points], G[points], margin[points] = evaluator.rank(
+                        evaluator.masked_gibbs_free_energies(P_flat[points], T_flat[points])
+                    )
+            yield C.reshape(P.shape), G.reshape(P.shape), margin.reshape(P.shape)
@@ -1,31 +1,104 @@
+import argparse
+import logging
 import os
 import yaml
 from pathlib import Path
 import sys
 
 from abstract import System
+from cache import GibbsFreeEnergyGridCache, GibbsFreeEnergyGridMemoryCache, default_cache_dir
+from incremental import IncrementalState
+from instrument import profiler
 from manager import PlotterManager
+from reader import GibbsFreeEnergyGridTableReader
+
+
+def add_reader_arguments(parser: argparse.ArgumentParser):
+    '''
+    Options of the table cache and of the table loading, shared with ``batch.py``.
+    '''
+    parser.add_argument('--cache-dir', default=default_cache_dir(), help='directory of the parsed table cache (default: %(default)s)')
+    parser.add_argument('--cache-size', type=float, default=1024, help='cache size limit in MiB (default: %(default)s)')
+    parser.add_argument('--no-cache', action='store_true', help='always parse the tables, neither reading nor writing the cache')
+    parser.add_argument('--clear-cache', action='store_true', help='remove every cached table before running')
+    parser.add_argument('--rebuild-cache', action='store_true', help='re-parse the tables of this run and overwrite their cached copies')
+    parser.add_argument('--workers', type=int, default=None, help='number of threads loading the substance tables (default: system.workers of the input file, or min(32, CPU cores + 4))')
+    parser.add_argument('--table-reader', choices=GibbsFreeEnergyGridTableReader.BACKENDS, default='streaming', help='table parser backend (default: %(default)s)')
+
+def add_diagnostic_arguments(parser: argparse.ArgumentParser):
+    '''
+    Options of the logging and of the profiler, shared with ``batch.py``.
+    '''
+    parser.add_argument('--verbose', '-v', action='count', default=0, help='log the progress (-v) or every evaluation (-vv)')
+    parser.add_argument('--profile', action='store_true', help='time the hot paths and print a report at the end')
+    parser.add_argument('--profile-json', metavar='FILE', default=None, help='also write the profiler report as JSON (implies --profile)')
+
+def setup_diagnostics(args):
+    logging.basicConfig(
+        level=[ logging.WARNING, logging.INFO, logging.DEBUG ][min(args.verbose, 2)],
+        format='%(levelname)s %(name)s: %(message)s'
+    )
+    profiler.enabled = args.profile or args.profile_json is not None
+
+def report_profile(args):
+    if not profiler.enabled: return
+    sys.stderr.write(profiler.format_table() + '\n')
+    if args.profile_json is not None: profiler.save(args.profile_json)
+
+def make_reader(args, memory_cache: GibbsFreeEnergyGridMemoryCache = None) -> GibbsFreeEnergyGridTableReader:
+    '''
+    The table reader set up by the options of ``add_reader_arguments``, clearing the cache when asked to.
+    '''
+    cache = None if args.no_cache else GibbsFreeEnergyGridCache(
+        os.path.abspath(args.cache_dir), int(args.cache_size * (1 << 20))
+    )
+
+    if args.clear_cache and cache is not None:
+        cache.clear()
+
+    return GibbsFreeEnergyGridTableReader(cache, rebuild=args.rebuild_cache, backend=args.table_reader, memory_cache=memory_cache)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Thermo phase diagrams with ease.')
+    parser.add_argument('config', metavar='CONFIG.yml', nargs='?', help='input file')
+    add_reader_arguments(parser)
+    add_diagnostic_arguments(parser)
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='number of processes rendering the plots (default: %(default)s)')
+    parser.add_argument('--incremental', action='store_true', help='only redo the plots whose inputs changed since the last incremental run')
+    parser.add_argument('--state-dir', default='.phdg', help='where the incremental runs keep their state, relative to the input file (default: %(default)s)')
+    return parser.parse_args(argv)
 
 
 if __name__ == '__main__':
 
-    if len(sys.argv) == 1:
+    args = parse_args()
+
+    setup_diagnostics(args)
+
+    if args.profile_json is not None:
+        args.profile_json = os.path.abspath(args.profile_json)
+
+    reader = make_reader(args)
+
+    if args.config is None:
+        if args.clear_cache: exit()
         sys.stderr.write('Usage: {} CONFIG.yml\n'.format(sys.argv[0]))
         exit()
 
-    config_path = Path(sys.argv[1])
+    config_path = Path(args.config)
 
     os.chdir(config_path.parent)
-        
+
     with open(config_path.name) as fp:
-        config = yaml.load(fp)
+        config = yaml.safe_load(fp)
 
-    system = System(config)
+    with profiler.timer('load substances'):
+        system = System(config, reader, args.workers)
     manager = PlotterManager(system)
 
-    for plot_options in config['plots']:
-        manager.plot(
-            plot_options["type"],
-            plot_options["output"],
-            **plot_options["args"]
-        )
\ No newline at end of file
+    state = IncrementalState(args.state_dir) if args.incremental else None
+
+    try:
+        manager.plot_all(config['plots'], args.jobs, state)
+    finally:
+        report_profile(args)
@@ -0,0 +1,170 @@
+import argparse
+import copy
+import glob
+import os
+import sys
+import time
+import yaml
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+from abstract import System
+from app import add_diagnostic_arguments, add_reader_arguments, make_reader, report_profile, setup_diagnostics
+from cache import GibbsFreeEnergyGridMemoryCache
+from instrument import profiler
+from manager import PlotterManager
+from reader import GibbsFreeEnergyGridTableReader
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Thermo phase diagrams of many systems at once.')
+    parser.add_argument('configs', metavar='CONFIG.yml', nargs='+', help='input files or glob patterns')
+    add_reader_arguments(parser)
+    add_diagnostic_arguments(parser)
+    parser.add_argument('--memory-cache-size', type=float, default=2048, help='size limit of the tables kept in memory by each process, in MiB (default: %(default)s)')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='number of processes the systems are spread over (default: %(default)s)')
+    return parser.parse_args(argv)
+
+def expand_configs(patterns: List[str]) -> List[str]:
+    '''
+    Input files matching ``patterns``, in order and without duplicates.
+    '''
+    configs = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [pattern]
+        if len(matches) == 0:
+            raise RuntimeError("No input file matches {}".format(pattern))
+        configs.extend(os.path.abspath(match) for match in matches)
+    return list(dict.fromkeys(configs))
+
+def resolve_paths(config: dict, directory: str) -> dict:
+    '''
+    A copy of ``config`` with the paths it holds (tables, outputs, phase map exports and inputs, shared table
+    directories, boundary exports and plot extensions) made relative to ``directory``, the directory of the input file. ``app.py`` changes into that directory instead,
+    which a process going through several input files cannot do.
+    '''
+    config = copy.deepcopy(config)
+    resolve = lambda path: os.path.join(directory, os.path.expanduser(path))
+    for substance in config['system']['substances']:
+        substance['gibbs_dir'] = resolve(substance['gibbs_dir'])
+    for plot_options in config['plots']:
+        plot_options['output'] = resolve(plot_options['output'])
+        args = plot_options.get('args') or {}
+        if 'extensions' in args:
+            args['extensions'] = [ resolve(extension) for extension in args['extensions'] ]
+        for name in ('export', 'phase_map', 'shared_dir'):
+            if args.get(name) is not None:
+                args[name] = resolve(args[name])
+        for boundary_options in args.get('boundaries', []):
+            if 'export' in boundary_options:
+                boundary_options['export'] = resolve(boundary_options['export'])
+    return config
+
+def schedule(configs: List[dict], jobs: int) -> List[List[int]]:
+    '''
+    Spread the input files (indices into ``configs``) over ``jobs`` groups, each processed by one process.
+    Every input file joins the group sharing the most tables with it among those not yet full, so that the
+    tables are loaded by as few processes as possible.
+    '''
+    groups = [ [] for _ in range(max(1, min(jobs, len(configs)))) ]
+    tables = [ set() for _ in groups ]
+    capacity = -(-len(configs) // len(groups))
+    for k, config in enumerate(configs):
+        config_tables = set(os.path.realpath(substance['gibbs_dir']) for substance in config['system']['substances'])
+        candidates = [ g for g in range(len(groups)) if len(groups[g]) < capacity ]
+        g = max(candidates, key=lambda g: (len(tables[g] & config_tables), -len(groups[g])))
+        groups[g].append(k)
+        tables[g] |= config_tables
+    return groups
+
+def run(config_path: str, config: dict, reader: GibbsFreeEnergyGridTableReader, workers: int = None) -> dict:
+    '''
+    Make the plots of one input file (``config``, with its paths resolved), timing the set-up of the system and
+    the plots. Errors are recorded rather than raised, so that the other input files still get processed.
+    '''
+    timing = {
+        'config': config_path, 'substances': len(config['system']['substances']), 'plots': len(config['plots']),
+        'system': 0., 'plot': 0., 'error': None
+    }
+    start = time.perf_counter()
+    try:
+        system = System(config, reader, workers)
+        timing['system'] = time.perf_counter() - start
+        PlotterManager(system).plot_all(config['plots'])
+    except Exception as e:
+        timing['error'] = str(e)
+    timing['plot'] = time.perf_counter() - start - timing['system']
+    return timing
+
+def run_group(config_paths: List[str], configs: List[dict], args) -> tuple:
+    '''
+    Process input files one after the other, sharing the tables they load through a memory cache. Returns their
+    timings, the statistics of the cache and the report of the profiler.
+    '''
+    setup_diagnostics(args)
+    profiler.reset()
+    memory_cache = GibbsFreeEnergyGridMemoryCache(int(args.memory_cache_size * (1 << 20)))
+    reader = make_reader(args, memory_cache)
+    timings = [ run(config_path, config, reader, args.workers) for config_path, config in zip(config_paths, configs) ]
+    return timings, (memory_cache.misses, memory_cache.hits, len(memory_cache), memory_cache.size), profiler.report()
+
+def print_summary(timings: List[dict], cache_stats: List[tuple], elapsed: float, file=sys.stderr):
+    width = max([ len(os.path.relpath(timing['config'])) for timing in timings ] + [6])
+    print('{:<{}}  {:>10}  {:>5}  {:>9}  {:>9}  {:>9}  {}'.format(
+        'config', width, 'substances', 'plots', 'system/s', 'plots/s', 'total/s', 'status'
+    ), file=file)
+    for timing in timings:
+        print('{:<{}}  {:>10}  {:>5}  {:>9.3f}  {:>9.3f}  {:>9.3f}  {}'.format(
+            os.path.relpath(timing['config']), width, timing['substances'], timing['plots'],
+            timing['system'], timing['plot'], timing['system'] + timing['plot'],
+            'ok' if timing['error'] is None else 'FAILED'
+        ), file=file)
+    loads, reuses, kept, size = (sum(stats[k] for stats in cache_stats) for k in range(4))
+    print('{} systems in {:.3f} s over {} processes; tables in memory: {} loads, {} reuses, {} kept ({:.1f} MiB)'.format(
+        len(timings), elapsed, len(cache_stats), loads, reuses, kept, size / (1 << 20)
+    ), file=file)
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+
+    setup_diagnostics(args)
+
+    config_paths = expand_configs(args.configs)
+    configs = []
+    for config_path in config_paths:
+        with open(config_path) as fp:
+            configs.append(resolve_paths(yaml.safe_load(fp), os.path.dirname(config_path)))
+
+    if args.clear_cache:
+        # Once, not in every process
+        make_reader(args)
+        args.clear_cache = False
+
+    start = time.perf_counter()
+
+    groups = schedule(configs, args.jobs)
+    if len(groups) == 1:
+        results = [ run_group(config_paths, configs, args) ]
+    else:
+        with ProcessPoolExecutor(max_workers=len(groups)) as executor:
+            futures = [
+                executor.submit(run_group, [ config_paths[k] for k in group ], [ configs[k] for k in group ], args)
+                for group in groups
+            ]
+        results = [ future.result() for future in futures ]
+
+    timings = [ None ] * len(configs)
+    for group, (group_timings, _, report) in zip(groups, results):
+        for k, timing in zip(group, group_timings):
+            timings[k] = timing
+        # The single group ran in this process
+        if len(groups) > 1: profiler.merge(report)
+
+    print_summary(timings, [ cache_stats for _, cache_stats, _ in results ], time.perf_counter() - start)
+    report_profile(args)
+
+    errors = [ ' - {}: {}'.format(timing['config'], timing['error']) for timing in timings if timing['error'] is not None ]
+    if len(errors) > 0:
+        raise RuntimeError("Failed to process {} of {} systems:\n{}".format(len(errors), len(timings), '\n'.join(errors)))
@@ -0,0 +1,294 @@
+from typing import Callable, List, Tuple
+
+import numpy
+
+class BoundaryTracer:
+    '''
+    Traces the curves where ``delta_g(P, T) = 0`` inside a P/T rectangle.
+
+    Zero crossings are first located on a coarse scan, ``scan_stride`` grid steps apart, and refined. From each
+    of them the curve is followed by continuation, in both directions: points are predicted ``step`` grid steps
+    apart along the current tangent, and each is corrected by bracketing the root on the normal through it and
+    narrowing the bracket to ``tolerance`` grid steps. Only the corrector needs function values, so ``delta_g``
+    is evaluated near the curve only.
+
+    The evaluations are batched: several points are predicted at once (more while the curve stays straight),
+    their normals are sampled in a single call, and all the brackets are narrowed together by sampling each at
+    ``samples`` points per call. No derivatives are used. With piecewise constant energies (nearest node
+    lookups) the boundary is a staircase, whose corners the normals miss: when no root is found next to the
+    predicted point, the curve is looked for on a circle around the last point, taking the crossing closest to
+    straight ahead, and the circle is widened up to ``max_width`` grid steps (at least ``scan_stride``; about a
+    table cell) before the curve is considered ended. Curves leaving the rectangle are clipped to its edge, and
+    pieces of curve whose ends meet are joined.
+
+    Coordinates are scaled by ``p_step`` and ``t_step`` internally, so both axes are resolved alike.
+    '''
+
+    delta_g: Callable
+    p_range: Tuple[float, float]
+    t_range: Tuple[float, float]
+    p_step: float
+    t_step: float
+    scan_stride: int
+    step: float
+    tolerance: float
+    samples: int
+    max_width: float
+    max_points: int
+
+    def __init__(self, delta_g: Callable, p_range: tuple, t_range: tuple, p_step: float, t_step: float, scan_stride: int = 8, step: float = 1, tolerance: float = 1e-3, samples: int = 17, max_width: float = None, max_points: int = 100000):
+        self.delta_g = delta_g
+        self.p_range = tuple(p_range)
+        self.t_range = tuple(t_range)
+        self.p_step = p_step
+        self.t_step = t_step
+        self.scan_stride = scan_stride
+        self.step = step
+        self.tolerance = tolerance
+        self.samples = max(3, samples)
+        self.max_width = max(scan_stride, 2 * step, max_width or 0)
+        self.max_points = max_points
+        self.num_evaluations = 0
+        self.num_calls = 0
+
+    @property
+    def extent(self) -> numpy.ndarray:
+        return numpy.array([
+            (self.p_range[1] - self.p_range[0]) / self.p_step,
+            (self.t_range[1] - self.t_range[0]) / self.t_step
+        ])
+
+    def to_pt(self, xy: numpy.ndarray) -> numpy.ndarray:
+        xy = numpy.asarray(xy)
+        return numpy.stack([
+            self.p_range[0] + xy[..., 0] * self.p_step,
+            self.t_range[0] + xy[..., 1] * self.t_step
+        ], axis=-1)
+
+    def evaluate(self, xy: numpy.ndarray) -> numpy.ndarray:
+        pt = self.to_pt(xy)
+        if pt[..., 0].size == 0: return numpy.zeros(pt.shape[:-1])
+        self.num_evaluations += pt[..., 0].size
+        self.num_calls += 1
+        return numpy.asarray(self.delta_g(pt[..., 0], pt[..., 1]), dtype='float64')
+
+    def inside(self, xy: numpy.ndarray) -> numpy.ndarray:
+        return numpy.all((xy >= 0) & (xy <= self.extent), axis=-1)
+
+    def clip(self, a: numpy.ndarray, b: numpy.ndarray) -> numpy.ndarray:
+        '''
+        Point where the segment from ``a`` (inside) to ``b`` (outside) leaves the rectangle
+        '''
+        d = b - a
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            t = numpy.where(b < 0, -a / d, numpy.where(b > self.extent, (self.extent - a) / d, 1))
+        return numpy.clip(a + numpy.min(t) * d, 0, self.extent)
+
+    def refine(self, a: numpy.ndarray, b: numpy.ndarray, f_a: numpy.ndarray) -> numpy.ndarray:
+        '''
+        Narrow the brackets ``[a, b]`` (one per row, ``f(a)`` and ``f(b)`` of opposite signs) all at once, each
+        call sampling ``samples`` points inside every bracket, until they are ``tolerance`` long.
+        '''
+        a, b = a.copy(), b.copy()
+        f_a = f_a.copy()
+        s = numpy.linspace(0, 1, self.samples)[1:-1]
+        length = numpy.max(numpy.linalg.norm(b - a, axis=-1), initial=0)
+        while length > self.tolerance and len(a) > 0:
+            points = a[:, None, :] + s[None, :, None] * (b - a)[:, None, :]
+            f = self.evaluate(points)
+            # Last sample still on the side of ``a``
+            same = numpy.sign(f) == numpy.sign(f_a)[:, None]
+            last = numpy.where(same.all(axis=1), len(s) - 1, numpy.argmin(same, axis=1) - 1)
+            rows = numpy.arange(len(a))
+            keep = last >= 0
+            new_a = numpy.where(keep[:, None], points[rows, numpy.maximum(last, 0)], a)
+            new_b = numpy.where((last + 1 < len(s))[:, None], points[rows, numpy.minimum(last + 1, len(s) - 1)], b)
+            f_a = numpy.where(keep, f[rows, numpy.maximum(last, 0)], f_a)
+            a, b = new_a, new_b
+            length /= len(s) + 1
+        return (a + b) / 2
+
+    def scan(self) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        '''
+        Zero crossings on the edges of the coarse scan grid, with the direction of the edge they lie on.
+        '''
+        nx, ny = self.extent
+        x = numpy.unique(numpy.append(numpy.arange(0, nx, self.scan_stride), nx))
+        y = numpy.unique(numpy.append(numpy.arange(0, ny, self.scan_stride), ny))
+        X, Y = numpy.meshgrid(x, y)
+        F = self.evaluate(numpy.stack([X, Y], axis=-1))
+        S = numpy.sign(F)
+
+        a, b, f_a, directions = [], [], [], []
+        for axis in (1, 0):
+            # Edges along P (axis 1) and along T (axis 0)
+            head = (slice(None), slice(None, -1)) if axis == 1 else (slice(None, -1), slice(None))
+            tail = (slice(None), slice(1, None)) if axis == 1 else (slice(1, None), slice(None))
+            crossing = S[head] * S[tail] < 0
+            a.append(numpy.stack([X[head][crossing], Y[head][crossing]], axis=-1))
+            b.append(numpy.stack([X[tail][crossing], Y[tail][crossing]], axis=-1))
+            f_a.append(F[head][crossing])
+            directions.append(numpy.tile([1., 0.] if axis == 1 else [0., 1.], (numpy.count_nonzero(crossing), 1)))
+
+        a, b, f_a = numpy.concatenate(a), numpy.concatenate(b), numpy.concatenate(f_a)
+        return self.refine(a, b, f_a), numpy.concatenate(directions)
+
+    def tangents(self, seeds: numpy.ndarray, directions: numpy.ndarray) -> numpy.ndarray:
+        '''
+        Initial tangents at the seeds, normal to a central difference gradient over half a scan cell (wide enough
+        for piecewise constant energies); normal to the scan edge where that gradient vanishes.
+        '''
+        h = max(self.step, self.scan_stride / 2)
+        offsets = h * numpy.array([[1., 0.], [-1., 0.], [0., 1.], [0., -1.]])
+        f = self.evaluate(seeds[:, None, :] + offsets[None, :, :])
+        tangents = numpy.stack([f[:, 3] - f[:, 2], f[:, 0] - f[:, 1]], axis=-1)
+        flat = numpy.linalg.norm(tangents, axis=-1) == 0
+        tangents[flat] = numpy.stack([-directions[flat, 1], directions[flat, 0]], axis=-1)
+        return tangents
+
+    def correct(self, predicted: numpy.ndarray, normal: numpy.ndarray, half_width: float) -> numpy.ndarray:
+        '''
+        Root of ``delta_g`` on each segment ``predicted[k] +- half_width * normal`` nearest to ``predicted[k]``,
+        NaN where the segment has none.
+        '''
+        s = numpy.linspace(-half_width, half_width, self.samples)
+        points = predicted[:, None, :] + s[None, :, None] * normal
+        f = self.evaluate(points)
+        sign = numpy.sign(f)
+        crossing = sign[:, :-1] * sign[:, 1:] <= 0
+        distance = numpy.where(crossing, numpy.abs(s[:-1] + s[1:]), numpy.inf)
+        k = numpy.argmin(distance, axis=1)
+        rows = numpy.arange(len(predicted))
+
+        roots = numpy.full(predicted.shape, numpy.nan)
+        found = numpy.isfinite(distance[rows, k])
+        exact_a = found & (f[rows, k] == 0)
+        exact_b = found & ~exact_a & (f[rows, k + 1] == 0)
+        roots[exact_a] = points[rows, k][exact_a]
+        roots[exact_b] = points[rows, k + 1][exact_b]
+        bracketed = found & ~exact_a & ~exact_b
+        roots[bracketed] = self.refine(points[rows, k][bracketed], points[rows, k + 1][bracketed], f[rows, k][bracketed])
+        return roots
+
+    def turn(self, center: numpy.ndarray, tangent: numpy.ndarray, radius: float) -> numpy.ndarray:
+        '''
+        Root of ``delta_g`` on the circle of ``radius`` around ``center`` closest to the direction ``tangent``,
+        not turning back by more than 120 degrees; None if there is none.
+        '''
+        angles = numpy.linspace(0, 2 * numpy.pi, max(self.samples, int(numpy.ceil(8 * numpy.pi * radius))))
+        points = center + radius * numpy.stack([numpy.cos(angles), numpy.sin(angles)], axis=-1)
+        f = self.evaluate(points)
+        sign = numpy.sign(f)
+        crossing = numpy.flatnonzero(sign[:-1] * sign[1:] <= 0)
+        if len(crossing) == 0: return None
+
+        directions = (points[crossing] + points[crossing + 1]) / 2 - center
+        cosines = directions @ tangent / numpy.linalg.norm(directions, axis=-1)
+        if numpy.max(cosines) < -0.5: return None
+        k = crossing[numpy.argmax(cosines)]
+        if f[k] == 0: return points[k]
+        if f[k + 1] == 0: return points[k + 1]
+        return self.refine(points[k:k + 1], points[k + 1:k + 2], f[k:k + 1])[0]
+
+    def follow(self, start: numpy.ndarray, tangent: numpy.ndarray, max_points: int) -> List[numpy.ndarray]:
+        points = [start]
+        # Cells of ``step`` the curve went through, to stop where it runs into itself
+        visited = { tuple(numpy.floor(start / self.step).astype(int)): 0 }
+        tangent = tangent / numpy.linalg.norm(tangent)
+        lookahead = 4
+        radius = self.step
+        while len(points) < max_points:
+            normal = numpy.array([-tangent[1], tangent[0]])
+            predicted = points[-1] + self.step * numpy.arange(1, lookahead + 1)[:, None] * tangent
+            roots = self.correct(predicted, normal, 2 * self.step)
+
+            accepted = 0
+            for root in roots:
+                if numpy.isnan(root[0]): break
+                if numpy.linalg.norm(root - points[-1]) <= self.tolerance: break
+                accepted += 1
+                if not self.accept(points, visited, root, max_points): return points
+
+            if accepted == 0:
+                # Nothing next to the predicted point: a corner (staircase of nearest node lookups), look around
+                root = self.turn(points[-1], tangent, radius)
+                if root is None or numpy.linalg.norm(root - points[-1]) <= self.tolerance:
+                    radius *= 2
+                    if radius > self.max_width: return points
+                    continue
+                if not self.accept(points, visited, root, max_points): return points
+                lookahead = 1
+            else:
+                lookahead = min(2 * lookahead, 64) if accepted == len(roots) else accepted
+
+            radius = self.step
+            direction = points[-1] - points[-2]
+            tangent = direction / numpy.linalg.norm(direction)
+        return points
+
+    def accept(self, points: List[numpy.ndarray], visited: dict, root: numpy.ndarray, max_points: int) -> bool:
+        '''
+        Append ``root`` to the curve, clipped to the rectangle; False when the curve ends there.
+        '''
+        if not self.inside(root):
+            points.append(self.clip(points[-1], root))
+            return False
+        points.append(root)
+        # Closed loop
+        if len(points) > 3 and numpy.linalg.norm(root - points[0]) < self.step:
+            points.append(points[0])
+            return False
+        cell = tuple(numpy.floor(root / self.step).astype(int))
+        if visited.setdefault(cell, len(points) - 1) < len(points) - 4: return False
+        return len(points) < max_points
+
+    def join(self, polylines: List[numpy.ndarray]) -> List[numpy.ndarray]:
+        '''
+        Join the open polylines (in scaled coordinates) whose ends are within ``2 * step`` of each other.
+        '''
+        polylines = list(polylines)
+        closed = lambda polyline: len(polyline) > 2 and numpy.array_equal(polyline[0], polyline[-1])
+        joined = True
+        while joined:
+            joined = False
+            for i in range(len(polylines)):
+                for j in range(i + 1, len(polylines)):
+                    u, v = polylines[i], polylines[j]
+                    if closed(u) or closed(v): continue
+                    for first, second in ((u, v), (u, v[::-1]), (u[::-1], v), (u[::-1], v[::-1])):
+                        if numpy.linalg.norm(first[-1] - second[0]) <= 2 * self.step:
+                            polylines[i] = numpy.concatenate([first, second])
+                            del polylines[j]
+                            joined = True
+                            break
+                    if joined: break
+                if joined: break
+        return polylines
+
+    def trace(self) -> List[numpy.ndarray]:
+        '''
+        Polylines of the boundary, each an ``(N, 2)`` array of (P, T) points.
+        '''
+        seeds, directions = self.scan()
+        tangents = self.tangents(seeds, directions)
+        remaining = numpy.ones(len(seeds), dtype=bool)
+        polylines = []
+
+        for k in range(len(seeds)):
+            if not remaining[k]: continue
+
+            tangent = tangents[k]
+            forward = self.follow(seeds[k], tangent, self.max_points)
+            if len(forward) > 1 and numpy.array_equal(forward[0], forward[-1]):
+                points = numpy.array(forward)
+            else:
+                backward = self.follow(seeds[k], -tangent, self.max_points)
+                points = numpy.array(backward[::-1] + forward[1:])
+
+            polylines.append(points)
+
+            # Seeds on this curve are done
+            distances = numpy.min(numpy.linalg.norm(seeds[:, None, :] - points[None, :, :], axis=-1), axis=1)
+            remaining &= distances > self.scan_stride / 2
+
+        return [ self.to_pt(polyline) for polyline in self.join(polylines) if len(polyline) > 1 ]
@@ -0,0 +1,262 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Optional
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+def default_cache_dir() -> str:
+    return os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'phdg')
+
+def hash_file(fname: str, block_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(fname, 'rb') as fp:
+        for block in iter(lambda: fp.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class GibbsFreeEnergyGridCache:
+    '''
+    On-disk cache of parsed Gibbs free energy tables.
+
+    Each parsed table is stored as three ``.npy`` files (pressure, temperature and G) in a directory named after
+    the SHA-256 of the source file, so later runs memory-map them instead of parsing the text again. A manifest
+    remembers the size and mtime of every source path: when they are unchanged the content hash is not
+    recomputed, when they differ the file is re-hashed and only re-parsed if its content actually changed.
+
+    The cache is bounded by ``max_size`` bytes; the least recently used entries are evicted first.
+
+    The manifest is read, modified and written under a thread lock and, where ``fcntl`` is available, an
+    exclusive lock on ``manifest.lock``, so that several processes (``--jobs``) can share the cache.
+    '''
+
+    MANIFEST = 'manifest.json'
+    LOCK = 'manifest.lock'
+    ARRAYS = ('pressure', 'temperature', 'gibbs_free_energies')
+
+    directory: str
+    max_size: int
+
+    def __init__(self, directory: Optional[str] = None, max_size: int = 1 << 30):
+        self.directory = directory if directory is not None else default_cache_dir()
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def __getstate__(self):
+        return { 'directory': self.directory, 'max_size': self.max_size }
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(self.directory, self.LOCK), 'a') as fp:
+                fcntl.flock(fp, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def _read_manifest(self) -> dict:
+        try:
+            with open(os.path.join(self.directory, self.MANIFEST)) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return { 'sources': {}, 'entries': {} }
+
+    def _write_manifest(self, manifest: dict):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.json')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(manifest, fp)
+        os.replace(tmp, os.path.join(self.directory, self.MANIFEST))
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def _source_key(self, fname: str) -> str:
+        '''
+        Content hash of ``fname``, re-hashing the file only when its size or mtime changed.
+        '''
+        path = os.path.abspath(fname)
+        stat = os.stat(path)
+        with self._locked():
+            source = self._read_manifest()['sources'].get(path)
+        if source is not None and source['size'] == stat.st_size and source['mtime_ns'] == stat.st_mtime_ns:
+            return source['hash']
+        # Hash outside of the lock, tables may be loaded from several threads
+        key = hash_file(path)
+        with self._locked():
+            manifest = self._read_manifest()
+            manifest['sources'][path] = { 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': key }
+            self._write_manifest(manifest)
+        return key
+
+    def load(self, fname: str) -> Optional[tuple]:
+        '''
+        Memory-mapped ``(pressure, temperature, gibbs_free_energies)`` for ``fname``, or ``None`` on a miss.
+        '''
+        key = self._source_key(fname)
+        with self._locked():
+            manifest = self._read_manifest()
+            entry = manifest['entries'].get(key)
+            if entry is None or not os.path.isdir(self._entry_dir(key)):
+                return None
+            entry['last_used'] = time.time()
+            self._write_manifest(manifest)
+        try:
+            return tuple(
+                numpy.load(os.path.join(self._entry_dir(key), name + '.npy'), mmap_mode='r')
+                for name in self.ARRAYS
+            )
+        except (OSError, ValueError):
+            return None
+
+    def store(self, fname: str, pressure_array, temperature_array, gibbs_free_energies):
+        key = self._source_key(fname)
+        tmp = tempfile.mkdtemp(dir=self.directory)
+        for name, array in zip(self.ARRAYS, (pressure_array, temperature_array, gibbs_free_energies)):
+            numpy.save(os.path.join(tmp, name + '.npy'), numpy.asarray(array, dtype='float64'))
+        with self._locked():
+            manifest = self._read_manifest()
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            os.replace(tmp, self._entry_dir(key))
+            manifest['entries'][key] = {
+                'size': sum(os.path.getsize(os.path.join(self._entry_dir(key), name + '.npy')) for name in self.ARRAYS),
+                'last_used': time.time()
+            }
+            self._evict(manifest, keep=key)
+            self._write_manifest(manifest)
+
+    def _evict(self, manifest: dict, keep: str):
+        entries = manifest['entries']
+        total = sum(entry['size'] for entry in entries.values())
+        for key in sorted(entries, key=lambda key: entries[key]['last_used']):
+            if total <= self.max_size: break
+            if key == keep: continue
+            total -= entries[key]['size']
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            del entries[key]
+        manifest['sources'] = {
+            path: source for path, source in manifest['sources'].items()
+            if source['hash'] in entries
+        }
+
+    def clear(self):
+        with self._locked():
+            manifest = self._read_manifest()
+            for key in manifest['entries']:
+                shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            self._write_manifest({ 'sources': {}, 'entries': {} })
+
+class GibbsFreeEnergyGridMemoryCache:
+    '''
+    In-process cache of loaded Gibbs free energy grids, so that the systems of a batch run referencing the same
+    table share one ``GibbsFreeEnergyGrid`` (and its interpolation coefficients) instead of loading it again.
+
+    Grids are keyed by the path, size and mtime of their table and by the interpolation mode. The cache is
+    bounded by ``max_size`` bytes of tables; the least recently used grids are evicted first. A table requested
+    by several threads at once is loaded by one of them only.
+    '''
+
+    max_size: int
+    hits: int
+    misses: int
+
+    def __init__(self, max_size: int = 1 << 30):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Grids stay in the process that loaded them
+        return { 'max_size': self.max_size }
+
+    def __setstate__(self, state: dict):
+        self.__init__(state['max_size'])
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @staticmethod
+    def _key(fname: str, interpolation: str) -> tuple:
+        path = os.path.abspath(fname)
+        stat = os.stat(path)
+        return (path, stat.st_size, stat.st_mtime_ns, interpolation)
+
+    def _get(self, key: tuple):
+        entry = self._entries.get(key)
+        if entry is None: return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def load(self, fname: str, interpolation: str, load: Callable):
+        '''
+        The grid of ``fname`` with ``interpolation``, from the cache or else from ``load()``.
+        '''
+        key = self._key(fname, interpolation)
+        with self._lock:
+            grid = self._get(key)
+            if grid is not None: return grid
+            key_lock = self._loading.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                grid = self._get(key)
+                if grid is not None: return grid
+            grid = load()
+            size = sum(
+                numpy.asarray(array).nbytes
+                for array in (grid.pressure_array, grid.temperature_array, grid.gibbs_free_energies)
+            )
+            with self._lock:
+                self.misses += 1
+                self._loading.pop(key, None)
+                self._entries[key] = (grid, size)
+                self._size += size
+                while self._size > self.max_size and len(self._entries) > 1:
+                    _, (_, evicted_size) = self._entries.popitem(last=False)
+                    self._size -= evicted_size
+        return grid
+
+    def axes(self, fname: str) -> Optional[tuple]:
+        '''
+        ``(pressure, temperature)`` axes of ``fname`` from any cached grid of it, or ``None``.
+        '''
+        path = os.path.abspath(fname)
+        stat = os.stat(path)
+        with self._lock:
+            for (entry_path, size, mtime_ns, _), (grid, _) in self._entries.items():
+                if (entry_path, size, mtime_ns) == (path, stat.st_size, stat.st_mtime_ns):
+                    return grid.pressure_array, grid.temperature_array
+        return None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
@@ -0,0 +1,204 @@
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from typing import Callable, Dict, List, Optional
+import os
+import shutil
+
+import numpy
+
+from abstract import Combination, Substance
+from evaluator import GibbsFreeEnergyEvaluator
+from gibbs import GibbsFreeEnergyGrid
+from instrument import get_logger, profiler
+from reader import GibbsFreeEnergyGridTableReader
+
+try:
+    import mpi4py.futures
+except ImportError:
+    mpi4py = None
+
+logger = get_logger('distributed')
+
+class SerialExecutor(Executor):
+    '''
+    Runs every task in the calling process, when it is submitted.
+    '''
+
+    def __init__(self, max_workers: Optional[int] = None):
+        pass
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+class LocalMPIExecutor(Executor):
+    '''
+    Stand-in for ``mpi4py.futures.MPIPoolExecutor`` on a single machine without MPI. The tasks given to ``map``
+    are decomposed statically as over MPI ranks, rank ``r`` of ``max_workers`` taking the tasks ``r``,
+    ``r + max_workers``, ..., each rank being a local process; the results are gathered in order.
+    '''
+
+    def __init__(self, max_workers: Optional[int] = None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._pool = ProcessPoolExecutor(max_workers=self.max_workers)
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        return self._pool.submit(fn, *args, **kwargs)
+
+    def map(self, fn, *iterables, timeout=None, chunksize=1):
+        tasks = list(zip(*iterables))
+        ranks = [ self._pool.submit(_run_rank, fn, tasks[r::self.max_workers]) for r in range(self.max_workers) ]
+        gathered = [ rank.result(timeout) for rank in ranks ]
+        return iter([ gathered[k % self.max_workers][k // self.max_workers] for k in range(len(tasks)) ])
+
+    def shutdown(self, wait: bool = True, **kwargs):
+        self._pool.shutdown(wait)
+
+def _run_rank(fn, tasks: list) -> list:
+    return [ fn(*task) for task in tasks ]
+
+def mpi_executor(max_workers: Optional[int] = None) -> Executor:
+    '''
+    ``mpi4py.futures.MPIPoolExecutor`` (run under ``mpiexec -n N python -m mpi4py.futures``) when mpi4py is
+    installed, the ``LocalMPIExecutor`` stand-in otherwise.
+    '''
+    if mpi4py is None:
+        logger.warning('mpi4py is not installed, tiles are computed by local processes instead')
+        return LocalMPIExecutor(max_workers)
+    return mpi4py.futures.MPIPoolExecutor(max_workers)
+
+# Executor factories by name, taking the number of workers
+EXECUTORS: Dict[str, Callable[[Optional[int]], Executor]] = {
+    'serial': SerialExecutor,
+    'process': lambda max_workers: ProcessPoolExecutor(max_workers=max_workers),
+    'mpi': mpi_executor
+}
+
+def register_executor(name: str, factory: Callable[[Optional[int]], Executor]):
+    if name in EXECUTORS:
+        raise RuntimeError("Executor {} is already registered".format(name))
+    EXECUTORS[name] = factory
+
+def make_executor(name: str, max_workers: Optional[int] = None) -> Executor:
+    if name not in EXECUTORS:
+        raise RuntimeError("Unknown executor {}, expected one of {}".format(name, ', '.join(EXECUTORS)))
+    return EXECUTORS[name](max_workers)
+
+class SharedTableReader(GibbsFreeEnergyGridTableReader):
+    '''
+    Reads the tables written by ``SharedTables``, memory-mapped, so that the processes on a machine share one
+    copy of each through the page cache. The file names are the common prefixes of the ``.npy`` files of each
+    table.
+    '''
+
+    def load_axes(self, fname: str):
+        return numpy.load(fname + '.pressure.npy'), numpy.load(fname + '.temperature.npy')
+
+    def read_gibbs_free_energy(self, fname: str, interpolation: str = 'nearest'):
+        bicubic_coefficients = None
+        if os.path.exists(fname + '.bicubic.npy'):
+            bicubic_coefficients = numpy.load(fname + '.bicubic.npy', mmap_mode='r')
+        return GibbsFreeEnergyGrid(
+            *self.load_axes(fname), numpy.load(fname + '.gibbs.npy', mmap_mode='r'), interpolation, bicubic_coefficients
+        )
+
+class SharedTables:
+    '''
+    The tables of a set of substances written as ``.npy`` files into ``directory``, along with what the
+    workers need to rebuild the combinations on top of them (``spec``). The directory has to be visible to all
+    the workers, e.g. on a shared file system when they run on several nodes. Bicubic coefficients are written
+    too, so that the workers do not each compute their own.
+    '''
+
+    directory: str
+    spec: dict
+
+    def __init__(self, combinations: List[Combination], directory: str):
+        self.directory = directory
+        substances = list({ id(substance): substance for combination in combinations for _, substance in combination.substances }.values())
+        keys = { id(substance): k for k, substance in enumerate(substances) }
+        os.makedirs(directory, exist_ok=True)
+        for k, substance in enumerate(substances):
+            grid = substance.gibbs_free_energy
+            prefix = os.path.join(directory, str(k))
+            numpy.save(prefix + '.pressure.npy', numpy.asarray(grid.pressure_array, dtype='float64'))
+            numpy.save(prefix + '.temperature.npy', numpy.asarray(grid.temperature_array, dtype='float64'))
+            numpy.save(prefix + '.gibbs.npy', numpy.asarray(grid.gibbs_free_energies, dtype='float64'))
+            if grid.interpolation == 'bicubic' and min(grid.sorted_gibbs_free_energies.shape) >= 2:
+                numpy.save(prefix + '.bicubic.npy', grid.bicubic_coefficients)
+        self.spec = {
+            'directory': directory,
+            'substances': [
+                {
+                    'name': substance.substance_name, 'type': substance.substance_type,
+                    'gibbs_dir': os.path.join(directory, str(k)),
+                    'num_formula_units': substance.gibbs_free_energy_num_formula_units,
+                    'interpolation': substance.gibbs_free_energy_interpolation
+                } for k, substance in enumerate(substances)
+            ],
+            'combinations': [ [ (coefficient, keys[id(substance)]) for coefficient, substance in combination.substances ] for combination in combinations ]
+        }
+
+    @staticmethod
+    def open(spec: dict) -> List[Combination]:
+        '''
+        The combinations of ``spec``, on memory-mapped tables
+        '''
+        reader = SharedTableReader()
+        substances = [
+            Substance(s['name'], s['type'], s['gibbs_dir'], s['num_formula_units'], s['interpolation'], reader)
+            for s in spec['substances']
+        ]
+        return [ Combination([ (coefficient, substances[k]) for coefficient, k in terms ]) for terms in spec['combinations'] ]
+
+    def remove(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+# Per process, the evaluator of each shared directory
+_evaluators: dict = {}
+
+def _fill_tile(spec: dict, task: dict) -> numpy.ndarray:
+    key = spec['directory']
+    if key not in _evaluators:
+        _evaluators.clear()
+        _evaluators[key] = GibbsFreeEnergyEvaluator(SharedTables.open(spec))
+    evaluator = _evaluators[key]
+    P, T = numpy.meshgrid(task['p_array'], task['t_array'])
+    p_bounds, t_bounds = numpy.array(task['p_bounds']), numpy.array(task['t_bounds'])
+    # Ranges at the lower corner of the patches, as ``PhaseDiagramPlotter.range_mask``
+    P_corner = p_bounds[numpy.searchsorted(p_bounds, P, side='right') - 1]
+    T_corner = t_bounds[numpy.searchsorted(t_bounds, T, side='right') - 1]
+    C = evaluator.running_stable_combinations(P, T, evaluator.range_mask(P_corner, T_corner), task['precision'])
+    return C.astype(numpy.min_scalar_type(-max(len(evaluator.combinations), 1)))
+
+def fill_distributed(combinations: List[Combination], p_array: numpy.ndarray, t_array: numpy.ndarray, p_bounds: list, t_bounds: list, tile_size, executor: Executor, directory: str, precision: str = 'float64') -> numpy.ndarray:
+    '''
+    Stable combinations over the ``t_array`` x ``p_array`` grid (-1 where none is in range), the grid being
+    split into tiles of ``tile_size`` nodes evaluated by ``executor``. The tables of the combinations are shared
+    with the workers through ``SharedTables`` in ``directory``; the tiles are stitched back together here.
+    '''
+    rows, cols = numpy.broadcast_to(numpy.asarray(tile_size, dtype=int), 2)
+    if rows < 1 or cols < 1:
+        raise RuntimeError("The tile size must be positive, not {}".format(tile_size))
+    C_grid = numpy.full((len(t_array), len(p_array)), -1, dtype=int)
+    if len(combinations) == 0: return C_grid
+
+    tables = SharedTables(combinations, directory)
+    try:
+        tiles = [ (i, j) for i in range(0, len(t_array), rows) for j in range(0, len(p_array), cols) ]
+        tasks = [
+            {
+                'p_array': p_array[j:j + cols], 't_array': t_array[i:i + rows],
+                'p_bounds': list(p_bounds), 't_bounds': list(t_bounds), 'precision': precision
+            } for i, j in tiles
+        ]
+        logger.info('%d tiles of %d x %d nodes', len(tiles), rows, cols)
+        profiler.count('tiles', len(tiles))
+        for (i, j), C in zip(tiles, executor.map(_fill_tile, [ tables.spec ] * len(tasks), tasks)):
+            C_grid[i:i + rows, j:j + cols] = C
+    finally:
+        tables.remove()
+    return C_grid
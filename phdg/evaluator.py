@@ -0,0 +1,223 @@
+import numpy
+
+from instrument import profiler
+
+class GibbsFreeEnergyEvaluator:
+    '''
+    Evaluates the Gibbs free energies of many combinations on a common P/T grid.
+
+    Every distinct substance is evaluated once into a ``(substance, *grid)`` tensor, the energies of all the
+    combinations then follow by summing its rows term by term (coefficient and substance index of the n-th term
+    of every combination at once), which sums each combination in the same order as
+    ``Combination.get_gibbs_free_energy_unsafe`` and hence gives bitwise identical energies.
+    '''
+
+    combinations: list
+    substances: list
+    table: 'SubstanceEnergyTable'
+
+    def __init__(self, combinations: list, table: 'SubstanceEnergyTable' = None):
+        self.combinations = list(combinations)
+        self.table = table
+
+        substance_keys = {}
+        self.substances = []
+        for combination in self.combinations:
+            for _, substance in combination.substances:
+                if id(substance) not in substance_keys:
+                    substance_keys[id(substance)] = len(self.substances)
+                    self.substances.append(substance)
+
+        num_terms = max((len(combination.substances) for combination in self.combinations), default=0)
+
+        self._term_coefficients = []
+        self._term_substances = []
+        self._term_combinations = []
+
+        for n in range(num_terms):
+            combination_indices = [
+                k for k, combination in enumerate(self.combinations)
+                if len(combination.substances) > n
+            ]
+            self._term_combinations.append(numpy.array(combination_indices, dtype=numpy.intp))
+            self._term_coefficients.append(numpy.array([
+                self.combinations[k].substances[n][0] for k in combination_indices
+            ], dtype='float64'))
+            self._term_substances.append(numpy.array([
+                substance_keys[id(self.combinations[k].substances[n][1])] for k in combination_indices
+            ], dtype=numpy.intp))
+
+        # Per combination, its terms as (coefficient, substance index)
+        self._combination_terms = [
+            [ (coefficient, substance_keys[id(substance)]) for coefficient, substance in combination.substances ]
+            for combination in self.combinations
+        ]
+
+    def substance_gibbs_free_energies(self, P, T) -> numpy.ndarray:
+        '''
+        Gibbs free energy (per formula unit) of every distinct substance, shaped ``(len(substances), *grid)``.
+        Taken from ``table`` at the points it has.
+        '''
+        P, T = numpy.broadcast_arrays(numpy.asarray(P, dtype='float64'), numpy.asarray(T, dtype='float64'))
+        G = numpy.empty((len(self.substances),) + P.shape)
+        with profiler.timer('evaluate substances'):
+            for k, substance in enumerate(self.substances):
+                row = G[k:k + 1].reshape(P.shape)
+                found = None if self.table is None else self.table.lookup(substance, P, T, row)
+                if found is None:
+                    row[...] = substance.get_gibbs_free_energy(P, T)
+                elif not found.all():
+                    row[~found] = substance.get_gibbs_free_energy(P[~found], T[~found])
+                if found is not None: profiler.count('shared table points', int(numpy.count_nonzero(found)))
+        return G
+
+    def combine(self, substance_gibbs_free_energies: numpy.ndarray) -> numpy.ndarray:
+        '''
+        Sum the terms of every combination from a ``(substance, *grid)`` tensor into ``(combination, *grid)``.
+        '''
+        G = numpy.zeros((len(self.combinations),) + substance_gibbs_free_energies.shape[1:])
+        expand = (slice(None),) + (None,) * (substance_gibbs_free_energies.ndim - 1)
+        for n, (coefficients, substances, combinations) in enumerate(zip(self._term_coefficients, self._term_substances, self._term_combinations)):
+            term = coefficients[expand] * substance_gibbs_free_energies[substances]
+            if n == 0:
+                G[combinations] = term
+            else:
+                G[combinations] += term
+        return G
+
+    def gibbs_free_energies(self, P, T) -> numpy.ndarray:
+        '''
+        Gibbs free energy of every combination on the grid, shaped ``(len(combinations), *grid)``.
+        Like ``Combination.get_gibbs_free_energy_unsafe``, the ranges of the combinations are not checked.
+        '''
+        return self.combine(self.substance_gibbs_free_energies(P, T))
+
+    def range_mask(self, P, T) -> numpy.ndarray:
+        '''
+        Whether each grid point lies in the range of each combination, shaped ``(len(combinations), *grid)``.
+        Ranges are closed at the lower and open at the upper end.
+        '''
+        P, T = numpy.broadcast_arrays(numpy.asarray(P, dtype='float64'), numpy.asarray(T, dtype='float64'))
+        expand = (slice(None),) + (None,) * P.ndim
+        p_min, p_max = numpy.array([ combination.get_pressure_range() for combination in self.combinations ]).reshape(-1, 2).T
+        t_min, t_max = numpy.array([ combination.get_temperature_range() for combination in self.combinations ]).reshape(-1, 2).T
+        return (
+            (p_min[expand] <= P) & (P < p_max[expand]) &
+            (t_min[expand] <= T) & (T < t_max[expand])
+        )
+
+    def masked_gibbs_free_energies(self, P, T, mask: numpy.ndarray = None) -> numpy.ndarray:
+        '''
+        Like ``gibbs_free_energies``, but ``numpy.inf`` wherever a combination is out of its range
+        (or wherever ``mask``, when given, is false).
+        '''
+        G = self.gibbs_free_energies(P, T)
+        G[~(self.range_mask(P, T) if mask is None else mask)] = numpy.inf
+        return G
+
+    @staticmethod
+    def rank(G: numpy.ndarray) -> tuple:
+        '''
+        From the energies of combinations shaped ``(combination, *grid)``, ``numpy.inf`` where out of range:
+        the index of the lowest at each point (-1 where none is in range), its energy (NaN there) and the margin
+        to the runner-up (``numpy.inf`` where it is the only one in range).
+        '''
+        if len(G) == 0:
+            return numpy.full(G.shape[1:], -1), numpy.full(G.shape[1:], numpy.nan), numpy.full(G.shape[1:], numpy.nan)
+        C = numpy.argmin(G, axis=0)
+        G_min = numpy.take_along_axis(G, C[None], axis=0)[0]
+        G_second = numpy.partition(G, 1, axis=0)[1] if len(G) > 1 else numpy.full(G_min.shape, numpy.inf)
+        with numpy.errstate(invalid='ignore'):
+            margin = G_second - G_min
+        none = numpy.isinf(G_min)
+        C[none] = -1
+        G_min[none] = numpy.nan
+        margin[none] = numpy.nan
+        return C, G_min, margin
+
+    def stable_combinations(self, P, T, mask: numpy.ndarray = None) -> numpy.ndarray:
+        '''
+        Index of the combination with the lowest Gibbs free energy at each grid point, -1 where none is in range.
+        '''
+        G = self.masked_gibbs_free_energies(P, T, mask)
+        C = numpy.argmin(G, axis=0)
+        C[numpy.isinf(numpy.min(G, axis=0))] = -1
+        return C
+
+    def running_stable_combinations(self, P, T, mask: numpy.ndarray = None, dtype='float64') -> numpy.ndarray:
+        '''
+        Same as ``stable_combinations``, but the combinations are summed and compared one after the other against
+        a running minimum, so that besides the substance tensor only a few grid-sized arrays are held, whatever
+        the number of combinations. With ``dtype='float32'`` the sums and the minimum are kept in single
+        precision, which halves that memory but may move a boundary where two energies agree to about 1e-7.
+        '''
+        P, T = numpy.broadcast_arrays(numpy.asarray(P, dtype='float64'), numpy.asarray(T, dtype='float64'))
+        S = self.substance_gibbs_free_energies(P, T).astype(dtype, copy=False)
+        G_min = numpy.full(P.shape, numpy.inf, dtype=dtype)
+        C = numpy.full(P.shape, -1, dtype=int)
+        G = numpy.empty(P.shape, dtype=dtype)
+        term = numpy.empty(P.shape, dtype=dtype)
+        for k, terms in enumerate(self._combination_terms):
+            # Summed term by term as in ``combine``
+            for n, (coefficient, substance) in enumerate(terms):
+                numpy.multiply(S[substance], S.dtype.type(coefficient), out=G if n == 0 else term)
+                if n > 0: G += term
+            lower = G < G_min
+            if mask is not None: lower &= mask[k]
+            numpy.copyto(G_min, G, where=lower)
+            C[lower] = k
+        return C
+
+class SubstanceEnergyTable:
+    '''
+    Gibbs free energies of substances precomputed at sets of P/T points, one set per substance, to be shared by
+    the evaluators of several plots.
+
+    The points of each substance are kept sorted as complex numbers ``P + 1j * T``, so looking up a grid is a
+    ``searchsorted``. Evaluators take from the table the points it has and evaluate the others themselves.
+    '''
+
+    substances: list
+    points: list
+    gibbs_free_energies: list
+
+    def __init__(self, substances: list, points: list):
+        '''
+        ``points[k]``, as returned by ``as_points``, are the points at which ``substances[k]`` is evaluated.
+        '''
+        self.substances = list(substances)
+        self._rows = { id(substance): k for k, substance in enumerate(self.substances) }
+
+        self.points = [ numpy.unique(substance_points) for substance_points in points ]
+        self.gibbs_free_energies = [
+            substance.get_gibbs_free_energy(substance_points.real, substance_points.imag)
+            for substance, substance_points in zip(self.substances, self.points)
+        ]
+
+    @staticmethod
+    def as_points(P, T) -> numpy.ndarray:
+        P, T = numpy.broadcast_arrays(numpy.asarray(P, dtype='float64'), numpy.asarray(T, dtype='float64'))
+        return (P + 1j * T).ravel()
+
+    @property
+    def size(self) -> int:
+        '''
+        Number of energies in the table
+        '''
+        return sum(len(substance_points) for substance_points in self.points)
+
+    def lookup(self, substance, P, T, out: numpy.ndarray) -> numpy.ndarray:
+        '''
+        Copy the energies of ``substance`` at the points of the ``P``, ``T`` grid that are in the table into
+        ``out`` (shaped like the grid) and return where they were found, or ``None`` when none were.
+        '''
+        if id(substance) not in self._rows: return None
+        k = self._rows[id(substance)]
+        table_points = self.points[k]
+        points = self.as_points(P, T)
+        if len(table_points) == 0 or points.size == 0: return None
+        indices = numpy.minimum(numpy.searchsorted(table_points, points), len(table_points) - 1)
+        found = table_points[indices] == points
+        if not found.any(): return None
+        out.reshape(-1)[found] = self.gibbs_free_energies[k][indices[found]]
+        return found.reshape(out.shape)
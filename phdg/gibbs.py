@@ -1,13 +1,141 @@
+import logging
+
 import numpy
 
+from instrument import get_logger, profiler
+
+logger = get_logger('gibbs')
+
+def _derivative(a: numpy.ndarray, x: numpy.ndarray, axis: int) -> numpy.ndarray:
+    '''
+    Derivative of ``a`` along ``axis`` over the nodes ``x``, by central differences, second order accurate at the
+    edges too when there are enough nodes; zero along an axis of a single node.
+    '''
+    if len(x) < 2: return numpy.zeros_like(a)
+    return numpy.gradient(a, x, axis=axis, edge_order=2 if len(x) >= 3 else 1)
+
+class AxisIndex:
+    '''
+    Maps coordinates onto the nearest tabulated node of one axis of a Gibbs free energy grid.
+
+    The axis is sorted once, so a whole array of coordinates is resolved with a single ``searchsorted`` pass
+    (or with plain arithmetic when the axis is uniformly spaced). Ties are resolved the same way as
+    ``numpy.argmin(numpy.abs(axis - x))``, i.e. towards the first occurrence in the original axis.
+    '''
+
+    def __init__(self, axis):
+        self._axis = numpy.asarray(axis, dtype='float64')
+        self._values, self._first_indices = numpy.unique(self._axis, return_index=True)
+        self._step = None
+        if len(self._values) > 1:
+            step = (self._values[-1] - self._values[0]) / (len(self._values) - 1)
+            nodes = self._values[0] + step * numpy.arange(len(self._values))
+            if step > 0 and numpy.all(numpy.abs(self._values - nodes) <= 1e-6 * step):
+                self._step = step
+
+    @property
+    def values(self) -> numpy.ndarray:
+        return self._values
+
+    @property
+    def first_indices(self) -> numpy.ndarray:
+        return self._first_indices
+
+    @property
+    def is_uniform(self) -> bool:
+        return self._step is not None
+
+    def _right_neighbours(self, x: numpy.ndarray) -> numpy.ndarray:
+        '''
+        Index (into the sorted unique axis) of a node right of ``x``, clipped to ``[1, n - 1]``.
+        '''
+        if self._step is not None:
+            with numpy.errstate(invalid='ignore'):
+                k = numpy.floor((x - self._values[0]) / self._step)
+            k = numpy.nan_to_num(k, nan=0, posinf=len(self._values), neginf=0)
+            return numpy.clip(k, 0, len(self._values) - 2).astype(numpy.intp) + 1
+        return numpy.clip(numpy.searchsorted(self._values, x, side='left'), 1, len(self._values) - 1)
+
+    def locate(self, x) -> tuple:
+        '''
+        Cell (into the sorted unique axis) holding ``x`` and the fractional position of ``x`` within it.
+
+        Coordinates outside the axis are clamped onto its first / last node.
+        '''
+        x = numpy.asarray(x, dtype='float64')
+        left = self._right_neighbours(x) - 1
+        width = self._values[left + 1] - self._values[left]
+        return left, numpy.clip((x - self._values[left]) / width, 0, 1)
+
+    def nearest(self, x) -> numpy.ndarray:
+        '''
+        Indices (into the original axis) of the nodes nearest to ``x``.
+        '''
+        x = numpy.asarray(x, dtype='float64')
+        if len(self._values) == 1:
+            return numpy.full(x.shape, self._first_indices[0], dtype=numpy.intp)
+        right = self._right_neighbours(x)
+        left = right - 1
+        d_left = numpy.abs(self._values[left] - x)
+        d_right = numpy.abs(self._values[right] - x)
+        i_left = self._first_indices[left]
+        i_right = self._first_indices[right]
+        take_right = (d_right < d_left) | ((d_right == d_left) & (i_right < i_left))
+        # ``argmin`` over an all-NaN distance vector picks the first node
+        return numpy.where(numpy.isnan(x), 0, numpy.where(take_right, i_right, i_left))
+
+    def nearest_sorted(self, x) -> numpy.ndarray:
+        '''
+        Indices (into the sorted unique axis) of the nodes nearest to ``x``.
+        '''
+        return numpy.searchsorted(self._values, self._axis[self.nearest(x)])
+
 class GibbsFreeEnergyGrid:
+    '''
+    Gibbs free energy tabulated over a (T, P) grid. ``gibbs_free_energies[i, j]`` is G at
+    ``temperature_array[i]`` and ``pressure_array[j]``.
+
+    Values between the nodes are obtained with one of the ``INTERPOLATION_MODES``:
+
+    - ``nearest``: snap to the nearest tabulated node (the default);
+    - ``bilinear``: bilinear interpolation within each cell;
+    - ``bicubic`` (alias ``spline``): bicubic Hermite patches using finite difference derivatives.
+
+    Interpolation coefficients are computed once, on the first evaluation, and reused afterwards, unless
+    precomputed ``bicubic_coefficients`` are given. Coordinates outside the table are clamped onto its edges.
+
+    The derived quantities ``v_pt`` (V = dG/dP), ``s_pt`` (S = -dG/dT), ``h_pt`` (H = G + TS) and ``cp_pt``
+    (Cp = -T d2G/dT2) are in the units of the table per GPa and per K. With bicubic interpolation they are the
+    derivatives of the patches; otherwise they are looked up, like G, in finite difference ``gradients`` of the
+    table, computed once on first use.
+    '''
+
+    INTERPOLATION_MODES = ('nearest', 'bilinear', 'bicubic', 'spline')
+
+    # Maps (f(0), f(1), f'(0), f'(1)) onto the coefficients of the cubic on [0, 1]
+    _HERMITE = numpy.array([
+        [ 1,  0,  0,  0],
+        [ 0,  0,  1,  0],
+        [-3,  3, -2, -1],
+        [ 2, -2,  1,  1]
+    ], dtype='float64')
 
     num_formula_units: float
 
-    def __init__(self, pressure_array, temperature_array, gibbs_free_energies):
+    def __init__(self, pressure_array, temperature_array, gibbs_free_energies, interpolation: str = 'nearest', bicubic_coefficients=None):
+        if interpolation not in self.INTERPOLATION_MODES:
+            raise RuntimeError("Unknown interpolation mode {}, expected one of {}".format(
+                interpolation, ', '.join(self.INTERPOLATION_MODES)
+            ))
         self._pressure_array = pressure_array
         self._temperature_array = temperature_array
         self._gibbs_free_energies = gibbs_free_energies
+        self._interpolation = 'bicubic' if interpolation == 'spline' else interpolation
+        self._pressure_index = AxisIndex(pressure_array)
+        self._temperature_index = AxisIndex(temperature_array)
+        self._sorted_gibbs_free_energies = None
+        self._bicubic_coefficients = bicubic_coefficients
+        self._gradients = None
 
     @staticmethod
     def load_table_from_file(fname: str):
@@ -27,21 +155,158 @@ class GibbsFreeEnergyGrid:
     @property
     def gibbs_free_energies(self):
         return self._gibbs_free_energies
+    @property
+    def interpolation(self) -> str:
+        return self._interpolation
+
+    @property
+    def sorted_gibbs_free_energies(self) -> numpy.ndarray:
+        '''
+        G over the sorted, de-duplicated temperature and pressure axes.
+        '''
+        if self._sorted_gibbs_free_energies is None:
+            t_indices, p_indices = self._temperature_index.first_indices, self._pressure_index.first_indices
+            if (
+                len(t_indices) == len(self.temperature_array) and numpy.all(numpy.diff(t_indices) > 0) and
+                len(p_indices) == len(self.pressure_array) and numpy.all(numpy.diff(p_indices) > 0)
+            ):
+                # Already sorted: no copy, a memory-mapped table stays shared
+                self._sorted_gibbs_free_energies = numpy.asarray(self.gibbs_free_energies, dtype='float64')
+            else:
+                self._sorted_gibbs_free_energies = numpy.asarray(self.gibbs_free_energies, dtype='float64')[
+                    numpy.ix_(t_indices, p_indices)
+                ]
+        return self._sorted_gibbs_free_energies
+
+    @property
+    def bicubic_coefficients(self) -> numpy.ndarray:
+        '''
+        Per-cell coefficients ``a[i, j, m, n]`` of ``sum(a[m, n] * u ** m * v ** n)``, where ``u`` and ``v`` are
+        the fractional temperature and pressure positions within cell ``(i, j)``.
+        '''
+        if self._bicubic_coefficients is None:
+            g = self.sorted_gibbs_free_energies
+            t, p = self._temperature_index.values, self._pressure_index.values
+            g_t, g_p = _derivative(g, t, 0), _derivative(g, p, 1)
+            g_tp = _derivative(g_t, p, 1)
+            # Derivatives with respect to the fractional cell coordinates
+            h_t = numpy.diff(t)[:, None]
+            h_p = numpy.diff(p)[None, :]
+            def corners(a):
+                return a[:-1, :-1], a[:-1, 1:], a[1:, :-1], a[1:, 1:]
+            f00, f01, f10, f11 = corners(g)
+            t00, t01, t10, t11 = (c * h_t for c in corners(g_t))
+            p00, p01, p10, p11 = (c * h_p for c in corners(g_p))
+            x00, x01, x10, x11 = (c * h_t * h_p for c in corners(g_tp))
+            F = numpy.stack([
+                numpy.stack([f00, f01, p00, p01], axis=-1),
+                numpy.stack([f10, f11, p10, p11], axis=-1),
+                numpy.stack([t00, t01, x00, x01], axis=-1),
+                numpy.stack([t10, t11, x10, x11], axis=-1)
+            ], axis=-2)
+            self._bicubic_coefficients = numpy.einsum('mk,...kl,nl->...mn', self._HERMITE, F, self._HERMITE)
+        return self._bicubic_coefficients
+
+    @property
+    def gradients(self) -> dict:
+        '''
+        ``dG/dT``, ``dG/dP`` and ``d2G/dT2`` over the sorted, de-duplicated axes (keys ``t``, ``p`` and ``tt``),
+        see ``_derivative``.
+        '''
+        if self._gradients is None:
+            g = self.sorted_gibbs_free_energies
+            t, p = self._temperature_index.values, self._pressure_index.values
+            g_t = _derivative(g, t, 0)
+            self._gradients = { 't': g_t, 'p': _derivative(g, p, 1), 'tt': _derivative(g_t, t, 0) }
+        return self._gradients
+
+    def _g_pt_nearest(self, p: numpy.ndarray, t: numpy.ndarray) -> numpy.ndarray:
+        return numpy.asarray(self.gibbs_free_energies)[
+            self._temperature_index.nearest(t),
+            self._pressure_index.nearest(p)
+        ]
+
+    def _g_pt_bilinear(self, p: numpy.ndarray, t: numpy.ndarray) -> numpy.ndarray:
+        g = self.sorted_gibbs_free_energies
+        i, u = self._temperature_index.locate(t)
+        j, v = self._pressure_index.locate(p)
+        return (
+            (1 - u) * ((1 - v) * g[i, j] + v * g[i, j + 1]) +
+            u * ((1 - v) * g[i + 1, j] + v * g[i + 1, j + 1])
+        )
+
+    def _g_pt_bicubic(self, p: numpy.ndarray, t: numpy.ndarray) -> numpy.ndarray:
+        i, u = self._temperature_index.locate(t)
+        j, v = self._pressure_index.locate(p)
+        powers = numpy.arange(4)
+        return numpy.einsum(
+            '...m,...mn,...n->...',
+            u[..., None] ** powers, self.bicubic_coefficients[i, j], v[..., None] ** powers
+        )
+
+    def _derivative_pt_bicubic(self, p: numpy.ndarray, t: numpy.ndarray, key: str) -> numpy.ndarray:
+        i, u = self._temperature_index.locate(t)
+        j, v = self._pressure_index.locate(p)
+        powers = numpy.arange(4)
+        def derivative_powers(x, order):
+            # d^order/dx^order of x ** powers
+            factors = numpy.ones(4)
+            for k in range(order):
+                factors = factors * (powers - k)
+            return factors * x[..., None] ** numpy.maximum(powers - order, 0)
+        if key == 'p':
+            h = numpy.diff(self._pressure_index.values)[j]
+            u_powers, v_powers = derivative_powers(u, 0), derivative_powers(v, 1)
+        else:
+            h = numpy.diff(self._temperature_index.values)[i] ** len(key)
+            u_powers, v_powers = derivative_powers(u, len(key)), derivative_powers(v, 0)
+        return numpy.einsum('...m,...mn,...n->...', u_powers, self.bicubic_coefficients[i, j], v_powers) / h
+
+    def _derivative_pt(self, p, t, key: str) -> numpy.ndarray:
+        '''
+        ``dG/dT``, ``dG/dP`` or ``d2G/dT2`` (``key`` ``t``, ``p`` or ``tt``) at the points ``(p, t)``
+        '''
+        p, t = numpy.broadcast_arrays(numpy.asarray(p, dtype='float64'), numpy.asarray(t, dtype='float64'))
+        profiler.count('derivative points', p.size)
+        with profiler.timer('derivative'):
+            if self.interpolation == 'bicubic' and min(self.sorted_gibbs_free_energies.shape) >= 2:
+                return self._derivative_pt_bicubic(p, t, key)
+            d = self.gradients[key]
+            if self.interpolation == 'nearest' or min(d.shape) < 2:
+                return d[self._temperature_index.nearest_sorted(t), self._pressure_index.nearest_sorted(p)]
+            i, u = self._temperature_index.locate(t)
+            j, v = self._pressure_index.locate(p)
+            return (
+                (1 - u) * ((1 - v) * d[i, j] + v * d[i, j + 1]) +
+                u * ((1 - v) * d[i + 1, j] + v * d[i + 1, j + 1])
+            )
+
+    def v_pt(self, p, t) -> numpy.ndarray:
+        return self._derivative_pt(p, t, 'p')
+
+    def s_pt(self, p, t) -> numpy.ndarray:
+        return -self._derivative_pt(p, t, 't')
+
+    def h_pt(self, p, t) -> numpy.ndarray:
+        return self.g_pt(p, t) + numpy.asarray(t, dtype='float64') * self.s_pt(p, t)
+
+    def cp_pt(self, p, t) -> numpy.ndarray:
+        return -numpy.asarray(t, dtype='float64') * self._derivative_pt(p, t, 'tt')
 
     #@units.wraps(units.Ryd, (None, units.GPa, units.K))
     def g_pt(self, p, t):
-        print((numpy.min(self.pressure_array), numpy.max(self.pressure_array)), '->', (numpy.min(p), numpy.max(p)))
-        print((numpy.min(self.temperature_array), numpy.max(self.temperature_array)), '->', (numpy.min(t), numpy.max(t)))
-        def _g_pt(p, t): 
-            try:
-                return self.gibbs_free_energies[
-                    numpy.argmin(numpy.abs(numpy.array(self.temperature_array) - t)),
-                    #self.temperature_array.tolist().index(t),
-                    numpy.argmin(numpy.abs(numpy.array(self.pressure_array) - p))
-                    #self.pressure_array.tolist().index(p)
-                ]
-            except IndexError as e:
-                print(len(self.pressure_array.tolist()))
-                print(len(self.temperature_array.tolist()))
-                raise RuntimeError('(P = %f, T = %f) not found in raw data: %s' % (p, t))
-        return numpy.vectorize(_g_pt)(p, t)
\ No newline at end of file
+        p, t = numpy.broadcast_arrays(numpy.asarray(p, dtype='float64'), numpy.asarray(t, dtype='float64'))
+        if logger.isEnabledFor(logging.DEBUG) and p.size > 0:
+            logger.debug('g_pt of %d points, P %s -> %s, T %s -> %s', p.size,
+                (numpy.min(self.pressure_array), numpy.max(self.pressure_array)), (numpy.min(p), numpy.max(p)),
+                (numpy.min(self.temperature_array), numpy.max(self.temperature_array)), (numpy.min(t), numpy.max(t))
+            )
+        profiler.count('g_pt points', p.size)
+        with profiler.timer('g_pt'):
+            # Interpolation needs at least one cell along each axis
+            if self.interpolation == 'nearest' or min(self.sorted_gibbs_free_energies.shape) < 2:
+                return self._g_pt_nearest(p, t)
+            elif self.interpolation == 'bilinear':
+                return self._g_pt_bilinear(p, t)
+            else:
+                return self._g_pt_bicubic(p, t)
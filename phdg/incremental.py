@@ -0,0 +1,130 @@
+from typing import List, Optional
+import copy
+import hashlib
+import json
+import os
+
+from abstract import System, Substance
+from cache import hash_file
+
+class IncrementalState:
+    '''
+    What the previous runs of an input file computed, kept in ``directory`` so that a run only redoes the plots
+    whose inputs changed.
+
+    Every plot gets a fingerprint made of its type, its arguments, the manifests of the system, the files named
+    by its ``input_file_options`` and, for each substance it depends on (see ``Plotter.get_dependencies``), the
+    content of its table, its ``num_formula_units`` and its interpolation. A plot whose fingerprint is the one
+    recorded when its output was last written, and whose output still exists, is skipped. The tables are
+    hashed once per content change: the hashes are recorded along with the size and modification time of each
+    table.
+
+    Plotters with ``phase_map_options`` also keep what they computed as a ``PhaseMap`` under ``maps/``, keyed by
+    the fingerprint of those options only, so that a plot whose styling changed is redrawn from its map instead
+    of being computed again.
+    '''
+
+    STATE_FNAME = 'state.json'
+
+    directory: str
+    tables: dict
+    plots: dict
+    _pending: dict
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._pending = {}
+        try:
+            with open(os.path.join(directory, self.STATE_FNAME)) as fp:
+                state = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            state = {}
+        self.tables = state.get('tables', {})
+        self.plots = state.get('plots', {})
+
+    def table_hash(self, fname: str) -> str:
+        fname = os.path.abspath(fname)
+        stat = os.stat(fname)
+        entry = self.tables.get(fname)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            entry = { 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': hash_file(fname) }
+            self.tables[fname] = entry
+        return entry['hash']
+
+    def substance_fingerprint(self, substance: Substance) -> list:
+        return [
+            substance.substance_name, substance.substance_type, self.table_hash(substance.gibbs_free_energy_fname),
+            substance.gibbs_free_energy_num_formula_units, substance.gibbs_free_energy_interpolation
+        ]
+
+    def file_fingerprint(self, fname) -> Optional[str]:
+        return self.table_hash(fname) if isinstance(fname, str) and os.path.isfile(fname) else None
+
+    @staticmethod
+    def digest(value) -> str:
+        return hashlib.sha256(json.dumps(value, sort_keys=True, default=list).encode()).hexdigest()
+
+    def map_fname(self, plotter, system: System, args: dict, dependencies: list) -> str:
+        options = plotter._load_kwargs(args)
+        key = self.digest([
+            type(plotter).__name__, { name: options[name] for name in plotter.phase_map_options },
+            system.substance_manifests, dependencies
+        ])
+        return os.path.join(self.directory, 'maps', key + '.npz')
+
+    def prepare(self, system: System, manager, plots: List[dict]) -> List[dict]:
+        '''
+        The entries of ``plots`` that have to be made again, with the arguments of those that keep a phase map
+        pointed to their map in the state directory. Maps no longer used by any plot are removed.
+        '''
+        outdated = []
+        maps = set()
+        for plot_options in plots:
+            plotter = manager.find_plotter(plot_options['type'])
+            args = plot_options.get('args') or {}
+            dependencies = [ self.substance_fingerprint(substance) for substance in plotter.get_dependencies(system, **args) ]
+            fingerprint = self.digest([
+                plot_options['type'], args, system.substance_manifests, dependencies,
+                [ self.file_fingerprint(fname) for name in plotter.input_file_options for fname in _as_list(args.get(name)) ]
+            ])
+
+            if len(plotter.phase_map_options) > 0 and args.get('export') is None and args.get('phase_map') is None:
+                map_fname = self.map_fname(plotter, system, args, dependencies)
+                maps.add(map_fname)
+                plot_options = copy.copy(plot_options)
+                plot_options['args'] = dict(args, export=map_fname)
+                if os.path.exists(map_fname):
+                    plot_options['args']['phase_map'] = map_fname
+
+            if self.plots.get(plot_options['output']) == fingerprint and os.path.exists(plot_options['output']):
+                continue
+            self._pending[id(plot_options)] = (plot_options['output'], fingerprint)
+            outdated.append(plot_options)
+
+        maps_dir = os.path.join(self.directory, 'maps')
+        if os.path.isdir(maps_dir):
+            for fname in os.listdir(maps_dir):
+                if os.path.join(maps_dir, fname) not in maps:
+                    os.remove(os.path.join(maps_dir, fname))
+        else:
+            os.makedirs(maps_dir)
+
+        return outdated
+
+    def done(self, plot_options: dict):
+        '''
+        Record that the plot ``plot_options``, as returned by ``prepare``, was made.
+        '''
+        output, fingerprint = self._pending.pop(id(plot_options))
+        self.plots[output] = fingerprint
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        fname = os.path.join(self.directory, self.STATE_FNAME)
+        with open(fname + '.tmp', 'w') as fp:
+            json.dump({ 'tables': self.tables, 'plots': self.plots }, fp, indent=1)
+        os.replace(fname + '.tmp', fname)
+
+def _as_list(value) -> list:
+    if value is None: return []
+    return list(value) if isinstance(value, (list, tuple)) else [ value ]
@@ -0,0 +1,92 @@
+from contextlib import contextmanager
+from typing import Optional
+import json
+import logging
+import threading
+import time
+
+def get_logger(name: str) -> logging.Logger:
+    '''
+    The logger of a phdg module, under the ``phdg`` logger.
+    '''
+    return logging.getLogger('phdg').getChild(name)
+
+class Profiler:
+    '''
+    Timers and counters of the hot paths, reported at the end of a run.
+
+    ``timer(name)`` times a block, recording the number of calls and the total time (the time of nested
+    timers is also counted by the enclosing ones); ``count(name, n)`` adds ``n`` to a counter. Both do nothing unless the profiler is
+    ``enabled``. A profiler is shared by the threads of a process; the ``report`` of another process is added
+    with ``merge``.
+    '''
+
+    enabled: bool
+    timers: dict
+    counters: dict
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.timers = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                calls, seconds = self.timers.get(name, (0, 0.))
+                self.timers[name] = (calls + 1, seconds + elapsed)
+
+    def count(self, name: str, n: int = 1):
+        if not self.enabled: return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def reset(self):
+        with self._lock:
+            self.timers = {}
+            self.counters = {}
+
+    def report(self) -> dict:
+        with self._lock:
+            return {
+                'timers': { name: { 'calls': calls, 'seconds': seconds } for name, (calls, seconds) in sorted(self.timers.items()) },
+                'counters': dict(sorted(self.counters.items()))
+            }
+
+    def merge(self, report: dict):
+        with self._lock:
+            for name, timer in report['timers'].items():
+                calls, seconds = self.timers.get(name, (0, 0.))
+                self.timers[name] = (calls + timer['calls'], seconds + timer['seconds'])
+            for name, n in report['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def format_table(self) -> str:
+        report = self.report()
+        width = max([ len(name) for name in list(report['timers']) + list(report['counters']) ] + [5])
+        lines = [ '{:<{}}  {:>10}  {:>10}  {:>12}'.format('timer', width, 'calls', 'total/s', 'per call/ms') ]
+        for name, timer in report['timers'].items():
+            lines.append('{:<{}}  {:>10}  {:>10.3f}  {:>12.3f}'.format(
+                name, width, timer['calls'], timer['seconds'], 1e3 * timer['seconds'] / max(timer['calls'], 1)
+            ))
+        if len(report['counters']) > 0:
+            lines.append('{:<{}}  {:>10}'.format('counter', width, 'value'))
+            for name, n in report['counters'].items():
+                lines.append('{:<{}}  {:>10}'.format(name, width, n))
+        return '\n'.join(lines)
+
+    def save(self, fname: str):
+        with open(fname, 'w') as fp:
+            json.dump(self.report(), fp, indent=1)
+
+# The profiler of the process
+profiler = Profiler()
@@ -1,6 +1,11 @@
-from typing import List
+from typing import List, Optional
 from abstract import System
-from plotters import Plotter, SubstanceFieldPlotter, CombinationFieldPlotter, GibbsDifferencePlotter
+from evaluator import SubstanceEnergyTable
+from incremental import IncrementalState
+from instrument import profiler
+from concurrent.futures import ProcessPoolExecutor
+import numpy
+from plotters import Plotter, SubstanceFieldPlotter, CombinationFieldPlotter, GibbsDifferencePlotter, GibbsDifferenceIsobaricPlotter
 from phase import PhaseDiagramPlotter
 
 class PlotterManager:
@@ -17,6 +22,7 @@ class PlotterManager:
             SubstanceFieldPlotter(),
             CombinationFieldPlotter(),
             GibbsDifferencePlotter(),
+            GibbsDifferenceIsobaricPlotter(),
             PhaseDiagramPlotter()
         ]
         self.system = system
@@ -33,4 +39,93 @@ class PlotterManager:
         except StopIteration:
             raise RuntimeError("Keyword {} not found!".format(plotter_type_keyword))
     def plot(self, plotter_type_keyword: str, output, **kwargs):
-        self.find_plotter(plotter_type_keyword).plot(self.system, output, **kwargs)
\ No newline at end of file
+        with profiler.timer('plot ' + plotter_type_keyword):
+            self.find_plotter(plotter_type_keyword).plot(self.system, output, **kwargs)
+    def plan(self, plots: List[dict]) -> Optional[SubstanceEnergyTable]:
+        '''
+        Gather the evaluation points of all the ``plots`` (entries of the ``plots`` block of the input file) and
+        evaluate, once, every substance at the points where more than one plot needs it. Each plot asks for the
+        substances of the combinations it actually evaluates on each of its grids. ``None`` is returned when no
+        point is shared.
+        '''
+        substances = {}
+        # Per substance, the distinct points needed by each plot
+        requests = {}
+        for plot_options in plots:
+            grids = self.find_plotter(plot_options['type']).get_evaluation_points(self.system, **(plot_options.get('args') or {}))
+            plot_requests = {}
+            for combinations, P, T in grids:
+                points = SubstanceEnergyTable.as_points(P, T)
+                for combination in combinations:
+                    for _, substance in combination.substances:
+                        substances[id(substance)] = substance
+                        plot_requests.setdefault(id(substance), []).append(points)
+            for key, points in plot_requests.items():
+                requests.setdefault(key, []).append(numpy.unique(numpy.concatenate(points)))
+
+        shared = {}
+        for key, plot_points in requests.items():
+            if len(plot_points) < 2: continue
+            points, counts = numpy.unique(numpy.concatenate(plot_points), return_counts=True)
+            if numpy.any(counts > 1): shared[key] = points[counts > 1]
+        if len(shared) == 0: return None
+
+        table_substances = [ substances[key] for key in shared ]
+        self.system.load_gibbs_free_energies(table_substances)
+        return SubstanceEnergyTable(table_substances, list(shared.values()))
+    def plot_all(self, plots: List[dict], jobs: Optional[int] = None, state: Optional[IncrementalState] = None):
+        '''
+        Make all the ``plots``, sharing the substance energies of the points they have in common. With ``jobs``
+        greater than one, the plots are rendered in a pool of that many processes, each holding a copy of the
+        system and of the shared energies; all the plots are attempted and the failures reported together.
+        With a ``state``, only the plots whose inputs changed since the last run are made.
+        '''
+        if state is not None:
+            plots = state.prepare(self.system, self, plots)
+        with profiler.timer('plan'):
+            self.system.energy_table = self.plan(plots)
+        try:
+            if jobs is None or jobs <= 1 or len(plots) <= 1:
+                for plot_options in plots:
+                    self.plot(plot_options['type'], plot_options['output'], **(plot_options.get('args') or {}))
+                    if state is not None: state.done(plot_options)
+                return
+
+            with ProcessPoolExecutor(
+                max_workers=min(jobs, len(plots)),
+                initializer=_initialize_worker, initargs=(self.system, self.plotters, profiler.enabled)
+            ) as executor:
+                futures = [
+                    executor.submit(_plot_in_worker, plot_options['type'], plot_options['output'], plot_options.get('args') or {})
+                    for plot_options in plots
+                ]
+
+            errors = []
+            for plot_options, future in zip(plots, futures):
+                try:
+                    profiler.merge(future.result())
+                    if state is not None: state.done(plot_options)
+                except Exception as e:
+                    errors.append(' - {} ({}): {}'.format(plot_options['output'], plot_options['type'], e))
+
+            if len(errors) > 0:
+                raise RuntimeError("Failed to render {} of {} plots:\n{}".format(
+                    len(errors), len(plots), '\n'.join(errors)
+                ))
+        finally:
+            self.system.energy_table = None
+            if state is not None: state.save()
+
+_worker_manager: Optional[PlotterManager] = None
+
+def _initialize_worker(system: System, plotters: List[Plotter], profile: bool):
+    global _worker_manager
+    _worker_manager = PlotterManager(system)
+    _worker_manager.plotters = plotters
+    profiler.enabled = profile
+
+def _plot_in_worker(plotter_type_keyword: str, output, kwargs: dict) -> dict:
+    # What the plot alone took, for the profiler of the main process
+    profiler.reset()
+    _worker_manager.plot(plotter_type_keyword, output, **kwargs)
+    return profiler.report()
@@ -1,20 +1,58 @@
 from typing import List
+import tempfile
 
 import numpy
 
 import matplotlib
-import matplotlib.pyplot as plt
+import matplotlib.axes
+import matplotlib.colors
+import matplotlib.figure
+import matplotlib.patches
 
 from abstract import Substance, Combination, System
+from evaluator import GibbsFreeEnergyEvaluator
+from boundary import BoundaryTracer
+from distributed import fill_distributed, make_executor
+from phasemap import PhaseMap
 
-from plotters import Plotter
+from plotters import Plotter, new_figure
+from instrument import get_logger, profiler
+
+logger = get_logger('phase')
 
 class PhaseDiagramPlotter(Plotter):
     '''
-    This module plots a phase diagram over a given range. It plot the entire diagram piece by piece.
+    This module plots a phase diagram over a given range.
+
+    The stable combinations are found by one of two engines, selected with the ``engine`` option:
+
+    - ``global``: evaluates all the combinations once over the entire grid, masks the out-of-range ones with
+      +inf and takes a single argmin;
+    - ``patch``: splits the grid into patches at the range edges of the combinations and plots the entire
+      diagram piece by piece.
+
+    With ``tile_size`` (nodes along each side of a tile, or ``[rows, columns]``), the ``global`` engine with
+    uniform refinement and the ``patch`` engine walk the grid tile by tile, keeping a running minimum over the
+    combinations (see ``GibbsFreeEnergyEvaluator.running_stable_combinations``), so that the memory they need is
+    set by the tile, not by the grid times the number of combinations; ``precision: float32`` halves it again.
+
+    With ``executor`` (``serial``, ``process``, ``mpi`` or one added with ``distributed.register_executor``),
+    the global engine hands the tiles (``tile_size``, 256 nodes by default) to ``workers`` workers of that
+    executor and stitches their results, see ``distributed.fill_distributed``; the tables are shared with the
+    workers through memory-mapped files in a temporary directory under ``shared_dir``.
+
+    With ``refinement: adaptive``, the global engine starts from a grid ``coarse_stride`` times coarser and only
+    subdivides the cells whose corners disagree on the stable combination, see ``fill_adaptive``.
+
+    With ``export: PATH``, the computed diagram is also saved as a ``PhaseMap`` (with the energies of all the
+    combinations when ``export_energies`` is set); ``phase_map: PATH`` plots a saved one instead of computing it.
     '''
 
     type_keywords: List[str] = [ "phase_diagram" ]
+
+    GLOBAL_CHUNK_BYTES: int = 1 << 26
+    phase_map_options: List[str] = [ "p_range", "p_step", "t_range", "t_step", "engine", "refinement", "coarse_stride", "precision" ]
+    input_file_options: List[str] = [ "extensions", "phase_map" ]
     default_options: dict = {
         "p_range": [-5, 300],
         "p_step": 5,
@@ -27,55 +65,138 @@ class PhaseDiagramPlotter(Plotter):
         "boundaries": [],
         "extensions": [],
         "phase_legend": True,
-        "colors": []
+        "colors": [],
+        "engine": "global",
+        "refinement": "uniform",
+        "coarse_stride": 16,
+        "tile_size": None,
+        "precision": "float64",
+        "executor": None,
+        "workers": None,
+        "shared_dir": None,
+        "export": None,
+        "export_energies": False,
+        "phase_map": None
     }
 
     def __init__(self) -> None:
         super().__init__()
 
-    def iterate_over_combination_by_description(self, combinations, combination_description):
-        for combination in combinations:
-            if len(combination.substances) == len(combination_description):
-                combination_names = [ substance[1].substance_name for substance in combination.substances ]
-                combination_types = [ substance[1].substance_type for substance in combination.substances ]
-                match = True
-                for substance_description in combination_description:
-                    if substance_description[0] not in combination_types or substance_description[1] not in combination_names:
-                        match = False
-                        break
-                if match: yield combination
+    def find_combination_by_description(self, system: System, combination_description) -> Combination:
+        combination = system.find_combination_by_description(combination_description)
+        if combination is None:
+            raise RuntimeError("No combination matches {}".format(combination_description))
+        return combination
 
-    def plot_boundary(self, ax: matplotlib.axes.Axes, system: System, boundary_options: dict):
+    def get_axes(self, options: dict) -> tuple:
+        '''
+        The pressure and temperature axes of the diagram
+        '''
+        p_min, p_max = numpy.ceil(numpy.array(options['p_range']) / options['p_step']) * options['p_step']
+        t_min, t_max = numpy.ceil(numpy.array(options['t_range']) / options['t_step']) * options['t_step']
+        return (
+            numpy.arange(p_min, p_max + options['p_step'], options['p_step']),
+            numpy.arange(t_min, t_max + options['t_step'], options['t_step'])
+        )
 
+    def get_boundary_axes(self, boundary_options: dict) -> tuple:
+        '''
+        The pressure and temperature axes of a boundary, which unlike those of the diagram exclude the upper ends
+        '''
         p_min, p_max = numpy.ceil(numpy.array(boundary_options['p_range']) / boundary_options['p_step']) * boundary_options['p_step']
         t_min, t_max = numpy.ceil(numpy.array(boundary_options['t_range']) / boundary_options['t_step']) * boundary_options['t_step']
-        
-        p_array = numpy.arange(p_min, p_max, boundary_options['p_step'])
-        t_array = numpy.arange(t_min, t_max, boundary_options['t_step'])
+        return (
+            numpy.arange(p_min, p_max, boundary_options['p_step']),
+            numpy.arange(t_min, t_max, boundary_options['t_step'])
+        )
 
-        p_grid, t_grid = numpy.meshgrid(p_array, t_array)
+    def get_dependencies(self, system: System, **kwargs) -> List[Substance]:
+        return list({ id(substance[1]): substance[1] for combination in system.find_combinations() for substance in combination.substances }.values())
 
-        combinations = system.find_combinations()
+    def get_evaluation_points(self, system: System, **kwargs) -> List[tuple]:
+        '''
+        The whole grid for the uniform global engine, with all the combinations (the adaptive refinement and the
+        patch engine evaluate their own subsets of it), and the grids of the contoured boundaries, with their two
+        combinations. Nothing when the diagram is read from a ``phase_map``.
+        '''
+        options = self._load_kwargs(kwargs)
+        points = []
+        if options['phase_map'] is not None: return points
+        if options['engine'] == 'global' and options['refinement'] != 'adaptive':
+            points.append((system.find_combinations(), *numpy.meshgrid(*self.get_axes(options))))
+        for boundary_options in options['boundaries']:
+            if boundary_options.get('method', 'contour') == 'contour':
+                points.append((
+                    [ self.find_combination_by_description(system, description) for description in boundary_options['combinations'][:2] ],
+                    *numpy.meshgrid(*self.get_boundary_axes(boundary_options))
+                ))
+        return points
 
-        matched_combinations = [
-            next(self.iterate_over_combination_by_description(combinations, boundary_options['combinations'][0])),
-            next(self.iterate_over_combination_by_description(combinations, boundary_options['combinations'][1]))
-        ]
+    def plot_boundary(self, ax: matplotlib.axes.Axes, system: System, boundary_options: dict):
 
-        print(matched_combinations)
+        p_array, t_array = self.get_boundary_axes(boundary_options)
 
-        g_grid = numpy.subtract(
-            matched_combinations[0].get_gibbs_free_energy_unsafe(p_grid, t_grid),
-            matched_combinations[1].get_gibbs_free_energy_unsafe(p_grid, t_grid)
-        )
+        matched_combinations = [
+            self.find_combination_by_description(system, boundary_options['combinations'][0]),
+            self.find_combination_by_description(system, boundary_options['combinations'][1])
+        ]
 
-        ax.contour(
-            p_grid, t_grid, g_grid, levels=[0], colors=['k'],
-            lw=1,
-            linestyles=boundary_options['line_style'] if 'line_style' in boundary_options else '-'
-        )
-    
-    def fill_patch(self, combinations: Combination, p_range: tuple, t_range: tuple, options: dict) -> numpy.ndarray:
+        logger.debug('boundary between %s and %s', *matched_combinations)
+
+        evaluator = system.get_evaluator(matched_combinations)
+        line_style = boundary_options['line_style'] if 'line_style' in boundary_options else '-'
+        method = boundary_options['method'] if 'method' in boundary_options else 'contour'
+
+        if method == 'trace' and any(
+            substance[1].gibbs_free_energy_interpolation == 'nearest'
+            for combination in matched_combinations for substance in combination.substances
+        ):
+            # Piecewise constant energies: the scan and the brackets of the tracer would evaluate more points
+            # than the whole grid of the contour
+            logger.warning('tracing needs smooth energies, the boundary between %s and %s is contoured instead', *matched_combinations)
+            method = 'contour'
+
+        if method == 'trace':
+            tracer = BoundaryTracer(
+                lambda P, T: numpy.subtract(*evaluator.gibbs_free_energies(P, T)),
+                (p_array[0], p_array[-1]), (t_array[0], t_array[-1]),
+                boundary_options['p_step'], boundary_options['t_step'],
+                **{ key: boundary_options[key] for key in ('scan_stride', 'step', 'tolerance') if key in boundary_options }
+            )
+            polylines = tracer.trace()
+            for polyline in polylines:
+                ax.plot(polyline[:, 0], polyline[:, 1], c='k', lw=1, linestyle=line_style)
+        elif method == 'contour':
+            p_grid, t_grid = numpy.meshgrid(p_array, t_array)
+            g_grid = numpy.subtract(*evaluator.gibbs_free_energies(p_grid, t_grid))
+            contour_set = ax.contour(
+                p_grid, t_grid, g_grid, levels=[0], colors=['k'],
+                lw=1,
+                linestyles=line_style
+            )
+            polylines = [ numpy.asarray(segment) for segment in contour_set.allsegs[0] if len(segment) > 0 ]
+        else:
+            raise RuntimeError("Unknown boundary method {}".format(method))
+
+        self.export_boundary(boundary_options, *matched_combinations, polylines)
+
+        return polylines
+
+    def export_boundary(self, boundary_options: dict, first: Combination, second: Combination, polylines: List[numpy.ndarray]):
+        '''
+        Save the polylines of a boundary to its ``export`` path, if any. With ``slopes: true``, each gets a third
+        column, the Clapeyron slope dP/dT (GPa / K) of the boundary at its points, see
+        ``Combination.get_clapeyron_slope``.
+        '''
+        if 'export' not in boundary_options: return
+        if boundary_options.get('slopes', False):
+            polylines = [
+                numpy.column_stack([ polyline, first.get_clapeyron_slope(second, polyline[:, 0], polyline[:, 1]) ])
+                for polyline in polylines
+            ]
+        numpy.savez(boundary_options['export'], *polylines)
+
+    def fill_patch(self, system: System, combinations: List[Combination], p_range: tuple, t_range: tuple, options: dict) -> numpy.ndarray:
         '''
         For each patch, all the combinations should exist. Then we could use the unsafe version of the Gibbs free energy getter.
         But we need to match back the combination key when we are back.
@@ -88,16 +209,212 @@ class PhaseDiagramPlotter(Plotter):
 
         P_grid, T_grid = numpy.meshgrid(P, T)
 
-        G_grid = numpy.empty((P_grid.shape[0], P_grid.shape[1], len(combinations)))
+        evaluator = system.get_evaluator(combinations)
 
-        for k, combination in enumerate(combinations):
+        if options['tile_size'] is not None:
+            return self.fill_tiles(P_grid, T_grid, options['tile_size'], lambda P, T: evaluator.running_stable_combinations(P, T, dtype=options['precision']))
 
-            G_grid[:, :, k] = combination.get_gibbs_free_energy_unsafe(P_grid, T_grid)
+        G_grid = evaluator.gibbs_free_energies(P_grid, T_grid)
 
-        C_grid = numpy.argmin(G_grid, axis=2)
+        C_grid = numpy.argmin(G_grid, axis=0)
 
         return C_grid
+
+    def fill_tiles(self, P_grid: numpy.ndarray, T_grid: numpy.ndarray, tile_size, fill_tile) -> numpy.ndarray:
+        '''
+        Stable combinations over the grid, given by ``fill_tile(P, T)`` on one tile of ``tile_size`` nodes at a
+        time.
+        '''
+        rows, cols = numpy.broadcast_to(numpy.asarray(tile_size, dtype=int), 2)
+        if rows < 1 or cols < 1:
+            raise RuntimeError("The tile size must be positive, not {}".format(tile_size))
+        C_grid = numpy.empty(P_grid.shape, dtype=int)
+        for i in range(0, P_grid.shape[0], rows):
+            for j in range(0, P_grid.shape[1], cols):
+                C_grid[i:i + rows, j:j + cols] = fill_tile(P_grid[i:i + rows, j:j + cols], T_grid[i:i + rows, j:j + cols])
+        return C_grid
     
+    def stable_combinations(self, evaluator: GibbsFreeEnergyEvaluator, P: numpy.ndarray, T: numpy.ndarray, p_bounds: list, t_bounds: list) -> numpy.ndarray:
+        '''
+        Stable combinations at the given points, -1 where none is in range.
+
+        To give the same diagram as ``fill_patches``, the ranges are checked at the lower corner of the patch
+        each point falls in, rather than at the point itself.
+        '''
+
+        return evaluator.stable_combinations(P, T, self.range_mask(evaluator, P, T, p_bounds, t_bounds))
+
+    def range_mask(self, evaluator: GibbsFreeEnergyEvaluator, P: numpy.ndarray, T: numpy.ndarray, p_bounds: list, t_bounds: list) -> numpy.ndarray:
+        '''
+        Whether each combination is in range at the lower corner of the patch each point falls in
+        '''
+        p_bounds, t_bounds = numpy.array(p_bounds), numpy.array(t_bounds)
+        P_corner = p_bounds[numpy.searchsorted(p_bounds, P, side='right') - 1]
+        T_corner = t_bounds[numpy.searchsorted(t_bounds, T, side='right') - 1]
+        return evaluator.range_mask(P_corner, T_corner)
+
+    def fill_global(self, system: System, combinations: List[Combination], P_grid: numpy.ndarray, T_grid: numpy.ndarray, p_bounds: list, t_bounds: list, options: dict) -> numpy.ndarray:
+        '''
+        Evaluate all the combinations over the entire grid at once, -1 marks the points where none is in range.
+        The grid is taken in chunks of rows, so that the energies of all the combinations over a chunk take
+        about ``GLOBAL_CHUNK_BYTES``, or in tiles of ``tile_size`` with a running minimum.
+        '''
+
+        if len(combinations) == 0: return numpy.full(P_grid.shape, -1, dtype=int)
+
+        evaluator = system.get_evaluator(combinations)
+
+        if options['tile_size'] is not None:
+            return self.fill_tiles(P_grid, T_grid, options['tile_size'], lambda P, T: evaluator.running_stable_combinations(
+                P, T, self.range_mask(evaluator, P, T, p_bounds, t_bounds), options['precision']
+            ))
+
+        rows = max(1, self.GLOBAL_CHUNK_BYTES // (8 * len(combinations) * P_grid.shape[1]))
+
+        C_grid = numpy.empty(P_grid.shape, dtype=int)
+        for i in range(0, P_grid.shape[0], rows):
+            C_grid[i:i + rows] = self.stable_combinations(evaluator, P_grid[i:i + rows], T_grid[i:i + rows], p_bounds, t_bounds)
+
+        return C_grid
+
+    def combination_energies(self, system: System, combinations: List[Combination], options: dict) -> numpy.ndarray:
+        '''
+        Gibbs free energies of all the combinations over the grid of ``get_axes``, shaped
+        ``(len(combinations), *grid)``, NaN where a combination is out of range (as ``fill_global`` checks it).
+        '''
+        p_bounds, t_bounds = self.get_bounds(combinations, options)
+        P_grid, T_grid = numpy.meshgrid(*self.get_axes(options))
+        G_grid = numpy.full((len(combinations),) + P_grid.shape, numpy.nan)
+        if len(combinations) == 0: return G_grid
+
+        evaluator = system.get_evaluator(combinations)
+
+        rows = max(1, self.GLOBAL_CHUNK_BYTES // (8 * len(combinations) * P_grid.shape[1]))
+        for i in range(0, P_grid.shape[0], rows):
+            P, T = P_grid[i:i + rows], T_grid[i:i + rows]
+            G = evaluator.gibbs_free_energies(P, T)
+            G[~self.range_mask(evaluator, P, T, p_bounds, t_bounds)] = numpy.nan
+            G_grid[:, i:i + rows] = G
+
+        return G_grid
+
+    def fill_adaptive(self, system: System, combinations: List[Combination], P_grid: numpy.ndarray, T_grid: numpy.ndarray, p_bounds: list, t_bounds: list, options: dict) -> numpy.ndarray:
+        '''
+        Quadtree refinement of the global engine. The stable combinations are first evaluated every
+        ``coarse_stride`` grid nodes and along the patch bounds; then, level by level, the cells whose four corners agree are filled with
+        that combination, and the others are split in four, evaluating only the new nodes, until cells are one
+        grid step wide. The result is rasterized onto the same grid as ``fill_global``.
+
+        A phase region lying entirely inside a coarse cell, touching none of its corners, is missed; lower
+        ``coarse_stride`` if the diagram has small islands.
+        '''
+
+        if len(combinations) == 0: return numpy.full(P_grid.shape, -1, dtype=int)
+
+        evaluator = system.get_evaluator(combinations)
+
+        num_t, num_p = P_grid.shape
+        stride = max(1, int(options['coarse_stride']))
+
+        C_grid = numpy.full(P_grid.shape, -1, dtype=int)
+        evaluated = numpy.zeros(P_grid.shape, dtype=bool)
+
+        def evaluate(rows: numpy.ndarray, cols: numpy.ndarray):
+            nodes = numpy.unique(numpy.ravel_multi_index((rows, cols), P_grid.shape))
+            nodes = nodes[~evaluated.flat[nodes]]
+            if len(nodes) == 0: return
+            C_grid.flat[nodes] = self.stable_combinations(evaluator, P_grid.flat[nodes], T_grid.flat[nodes], p_bounds, t_bounds)
+            evaluated.flat[nodes] = True
+
+        # Coarse nodes, plus the nodes on both sides of every patch bound: the set of combinations in range
+        # changes there, so no coarse cell should straddle one
+
+        def coarse_nodes(axis: numpy.ndarray, bounds: list) -> numpy.ndarray:
+            edges = numpy.searchsorted(axis, bounds)
+            return numpy.unique(numpy.clip(numpy.concatenate([
+                numpy.arange(0, len(axis), stride), [len(axis) - 1], edges - 1, edges
+            ]), 0, len(axis) - 1))
+
+        rows = coarse_nodes(T_grid[:, 0], t_bounds)
+        cols = coarse_nodes(P_grid[0, :], p_bounds)
+
+        evaluate(*(grid.ravel() for grid in numpy.meshgrid(rows, cols, indexing='ij')))
+
+        # Cells as (first row, last row, first column, last column)
+
+        i0, j0 = (grid.ravel() for grid in numpy.meshgrid(rows[:-1], cols[:-1], indexing='ij'))
+        i1, j1 = (grid.ravel() for grid in numpy.meshgrid(rows[1:], cols[1:], indexing='ij'))
+
+        while len(i0) > 0:
+
+            corners = C_grid[i0, j0]
+            uniform = (C_grid[i0, j1] == corners) & (C_grid[i1, j0] == corners) & (C_grid[i1, j1] == corners)
+
+            for cell in numpy.flatnonzero(uniform):
+                patch = (slice(i0[cell], i1[cell] + 1), slice(j0[cell], j1[cell] + 1))
+                C_grid[patch] = numpy.where(evaluated[patch], C_grid[patch], corners[cell])
+
+            # Split the remaining cells, cells one step wide have all their nodes evaluated already
+
+            split = ~uniform & ((i1 - i0 > 1) | (j1 - j0 > 1))
+            i0, i1, j0, j1 = i0[split], i1[split], j0[split], j1[split]
+            im, jm = (i0 + i1) // 2, (j0 + j1) // 2
+
+            evaluate(
+                numpy.concatenate([im, im, i0, i1, im]),
+                numpy.concatenate([j0, j1, jm, jm, jm])
+            )
+
+            i0, i1, j0, j1 = (
+                numpy.concatenate([i0, i0, im, im]),
+                numpy.concatenate([im, im, i1, i1]),
+                numpy.concatenate([j0, jm, j0, jm]),
+                numpy.concatenate([jm, j1, jm, j1])
+            )
+            keep = (i1 > i0) & (j1 > j0)
+            i0, i1, j0, j1 = i0[keep], i1[keep], j0[keep], j1[keep]
+
+        return C_grid
+
+    def fill_patches(self, system: System, combinations: List[Combination], P_grid: numpy.ndarray, T_grid: numpy.ndarray, p_bounds: list, t_bounds: list, options: dict) -> numpy.ndarray:
+
+        p_min, t_min = P_grid[0, 0], T_grid[0, 0]
+
+        C_grid = numpy.zeros(P_grid.shape, dtype=int)
+
+        combination_indices = { id(combination): k for k, combination in enumerate(combinations) }
+
+        for patch_p_min, patch_p_max in zip(p_bounds[:-1], p_bounds[1:]):
+            for patch_t_min, patch_t_max in zip(t_bounds[:-1], t_bounds[1:]):
+
+                # Find combinations for this area (<= or <)
+
+                patch_combinations = [
+                    combination for combination in combinations
+                    if  combination.get_pressure_range()[0]    <= patch_p_min and patch_p_min < combination.get_pressure_range()[1]
+                    and combination.get_temperature_range()[0] <= patch_t_min and patch_t_min < combination.get_temperature_range()[1]
+                ]
+
+                # Fill patch
+
+                C_patch = self.fill_patch(system, patch_combinations, (patch_p_min, patch_p_max), (patch_t_min, patch_t_max), options)
+
+                # Convert keys
+
+                if len(patch_combinations) == 0:
+                    C_patch_converted = C_patch
+                else:
+                    C_patch_converted = numpy.array([
+                        combination_indices[id(combination)] for combination in patch_combinations
+                    ])[C_patch]
+
+                C_grid[
+                    int((patch_t_min - t_min) / options['t_step']):int((patch_t_max - t_min) / options['t_step']),
+                    int((patch_p_min - p_min) / options['p_step']):int((patch_p_max - p_min) / options['p_step'])
+                ] = C_patch_converted
+
+        return C_grid
+
     def load_extension(self, fig: matplotlib.figure.Figure, ax: matplotlib.axes.Axes, extension_fname: str):
         import importlib.util
         spec = importlib.util.spec_from_file_location(f"{__name__}.{extension_fname[:-3]}", extension_fname)
@@ -105,13 +422,10 @@ class PhaseDiagramPlotter(Plotter):
         spec.loader.exec_module(foo)
         foo.__extended__(fig, ax)
 
-    def plot(self, system: System, output: str, **kwargs):
-
-        options = self._load_kwargs(kwargs)
-
-        plt.figure(figsize=(8, 4))
-
-        combinations = system.find_combinations()
+    def get_bounds(self, combinations: List[Combination], options: dict) -> tuple:
+        '''
+        The patch bounds, where the set of combinations in range changes, along P and along T
+        '''
 
         p_min, p_max = numpy.ceil(numpy.array(options['p_range']) / options['p_step']) * options['p_step']
         t_min, t_max = numpy.ceil(numpy.array(options['t_range']) / options['t_step']) * options['t_step']
@@ -136,38 +450,65 @@ class PhaseDiagramPlotter(Plotter):
         p_bounds = sorted(list(p_bounds))
         t_bounds = sorted(list(t_bounds))
 
-        P = numpy.arange(p_min, p_max + options['p_step'], options['p_step'])
-        T = numpy.arange(t_min, t_max + options['t_step'], options['t_step'])
+        return p_bounds, t_bounds
 
-        P_grid, T_grid = numpy.meshgrid(P, T)
-        C_grid = numpy.zeros(P_grid.shape, dtype=int)
-
-        for patch_p_min, patch_p_max in zip(p_bounds[:-1], p_bounds[1:]):
-            for patch_t_min, patch_t_max in zip(t_bounds[:-1], t_bounds[1:]):
+    def fill(self, system: System, combinations: List[Combination], options: dict) -> numpy.ndarray:
+        '''
+        Index of the stable combination at each node of the grid of ``get_axes``, -1 where none is in range,
+        computed by the selected engine.
+        '''
 
-                # Find combinations for this area (<= or <)
+        p_bounds, t_bounds = self.get_bounds(combinations, options)
+
+        P_grid, T_grid = numpy.meshgrid(*self.get_axes(options))
+
+        if options['precision'] not in ('float32', 'float64'):
+            raise RuntimeError("Unknown precision {}, expected float32 or float64".format(options['precision']))
+
+        with profiler.timer('fill'):
+            if options['executor'] is not None:
+                if options['engine'] != 'global' or options['refinement'] != 'uniform':
+                    raise RuntimeError("An executor needs the global engine with uniform refinement")
+                with make_executor(options['executor'], options['workers']) as executor:
+                    return fill_distributed(
+                        combinations, P_grid[0], T_grid[:, 0], p_bounds, t_bounds,
+                        256 if options['tile_size'] is None else options['tile_size'], executor,
+                        tempfile.mkdtemp(prefix='phdg-', dir=options['shared_dir']), options['precision']
+                    )
+            elif options['engine'] == 'global' and options['refinement'] == 'adaptive':
+                return self.fill_adaptive(system, combinations, P_grid, T_grid, p_bounds, t_bounds, options)
+            elif options['engine'] == 'global':
+                return self.fill_global(system, combinations, P_grid, T_grid, p_bounds, t_bounds, options)
+            elif options['engine'] == 'patch':
+                return self.fill_patches(system, combinations, P_grid, T_grid, p_bounds, t_bounds, options)
+            else:
+                raise RuntimeError("Unknown phase diagram engine {}".format(options['engine']))
 
-                patch_combinations = [
-                    combination for combination in combinations
-                    if  combination.get_pressure_range()[0]    <= patch_p_min and patch_p_min < combination.get_pressure_range()[1]
-                    and combination.get_temperature_range()[0] <= patch_t_min and patch_t_min < combination.get_temperature_range()[1]
-                ]
+    def plot(self, system: System, output: str, **kwargs):
 
-                # Fill patch
+        options = self._load_kwargs(kwargs)
 
-                C_patch = self.fill_patch(patch_combinations, (patch_p_min, patch_p_max), (patch_t_min, patch_t_max), options)
+        fig = new_figure(figsize=(8, 4))
+        ax = fig.add_subplot()
 
-                C_patch_converted = numpy.copy(C_patch)
+        combinations = system.find_combinations()
 
-                # Convert keys
+        p_min, p_max = numpy.ceil(numpy.array(options['p_range']) / options['p_step']) * options['p_step']
+        t_min, t_max = numpy.ceil(numpy.array(options['t_range']) / options['t_step']) * options['t_step']
 
-                for combination in patch_combinations:
-                    C_patch_converted[C_patch == patch_combinations.index(combination)] = combinations.index(combination)
+        p_bounds, t_bounds = self.get_bounds(combinations, options)
 
-                C_grid[
-                    int((patch_t_min - t_min) / options['t_step']):int((patch_t_max - t_min) / options['t_step']),
-                    int((patch_p_min - p_min) / options['p_step']):int((patch_p_max - p_min) / options['p_step'])
-                ] = C_patch_converted
+        phase_map = None
+        if options['phase_map'] is not None:
+            phase_map = PhaseMap.load(options['phase_map'])
+            if not phase_map.matches(combinations):
+                raise RuntimeError("The combinations of {} differ from those of the system".format(options['phase_map']))
+            p_array, t_array = self.get_axes(options)
+            if not (numpy.array_equal(phase_map.pressure_array, p_array) and numpy.array_equal(phase_map.temperature_array, t_array)):
+                raise RuntimeError("{} was computed on another P/T grid".format(options['phase_map']))
+            C_grid = phase_map.C_grid.astype(int)
+        else:
+            C_grid = self.fill(system, combinations, options)
 
         contour_levels = numpy.arange(-1.5, .5 + len(combinations), 1)
         contour_level_colors = [(1, 1, 1)] + [
@@ -175,11 +516,11 @@ class PhaseDiagramPlotter(Plotter):
             for c in range(len(combinations))
         ]
         for c in options['colors']:
-            combination = next(self.iterate_over_combination_by_description(combinations, c['combination']))
-            print(combination)
+            combination = self.find_combination_by_description(system, c['combination'])
+            logger.debug('%s coloured %s', combination, c['color'])
             contour_level_colors[combinations.index(combination) + 1] = c['color']
 
-        plt.imshow(
+        ax.imshow(
             C_grid,
             cmap=matplotlib.colors.ListedColormap(contour_level_colors),
             norm=matplotlib.colors.BoundaryNorm(contour_levels, len(combinations) + 1),
@@ -195,14 +536,14 @@ class PhaseDiagramPlotter(Plotter):
         if options['highlight_overlay']:
             c = numpy.ones((255, 1, 4))
             c[:, 0, 3] = numpy.linspace(0, options['highlight_alpha'], 255)
-            plt.imshow(c, extent=[p_min, p_max, t_min, t_max], aspect='auto', zorder=1, origin='lower')
+            ax.imshow(c, extent=[p_min, p_max, t_min, t_max], aspect='auto', zorder=1, origin='lower')
 
         if options['boundary_line']:
-            for p in p_bounds: plt.axvline(p, c='w', lw=.3, alpha=.3)
-            for t in t_bounds: plt.axhline(t, c='w', lw=.3, alpha=.3)
+            for p in p_bounds: ax.axvline(p, c='w', lw=.3, alpha=.3)
+            for t in t_bounds: ax.axhline(t, c='w', lw=.3, alpha=.3)
         
         if options['phase_legend'] != True:
-            plt.legend([
+            ax.legend([
                 matplotlib.patches.Patch(facecolor=c, ec=c, alpha=.7)
                 for c in contour_level_colors[:]
                 if contour_level_colors.index(c) - 1 in set(C_grid.flatten().tolist()) and contour_level_colors.index(c) != 0
@@ -214,13 +555,40 @@ class PhaseDiagramPlotter(Plotter):
 
         # Boundaries
 
+        boundaries = []
+        boundary_options_list = []
         for boundary_options in options['boundaries']:
-            self.plot_boundary(plt.gca(), system, boundary_options)
-        
+            first, second = (
+                self.find_combination_by_description(system, description)
+                for description in boundary_options['combinations'][:2]
+            )
+            saved = [] if phase_map is None else [
+                polylines for (i, j, polylines), saved_options in zip(phase_map.boundaries, phase_map.boundary_options)
+                if (i, j) == (combinations.index(first), combinations.index(second))
+                and PhaseMap.boundary_key(saved_options) == PhaseMap.boundary_key(boundary_options)
+            ]
+            if len(saved) > 0:
+                polylines = saved[0]
+                for polyline in polylines:
+                    ax.plot(polyline[:, 0], polyline[:, 1], c='k', lw=1, linestyle=boundary_options.get('line_style', '-'))
+                self.export_boundary(boundary_options, first, second, polylines)
+            else:
+                polylines = self.plot_boundary(ax, system, boundary_options)
+            boundaries.append((first, second, polylines))
+            boundary_options_list.append(boundary_options)
+
+        if options['export'] is not None:
+            PhaseMap.from_combinations(
+                *self.get_axes(options), C_grid, combinations, boundaries,
+                self.combination_energies(system, combinations, options) if options['export_energies'] else None,
+                boundary_options_list
+            ).save(options['export'])
+
         for extension_fname in options['extensions']:
-            self.load_extension(plt.gcf(), plt.gca(), extension_fname)
+            self.load_extension(fig, ax, extension_fname)
 
-        plt.xlabel("$P$ / GPa")
-        plt.ylabel("$T$ / K")
+        ax.set_xlabel("$P$ / GPa")
+        ax.set_ylabel("$T$ / K")
 
-        plt.savefig(output, dpi=300)
+        with profiler.timer('savefig'):
+            fig.savefig(output, dpi=300)
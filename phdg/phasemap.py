@@ -0,0 +1,180 @@
+from typing import List, Optional
+import json
+import os
+
+import numpy
+
+from evaluator import GibbsFreeEnergyEvaluator
+from gibbs import AxisIndex
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+class PhaseMap:
+    '''
+    A computed phase diagram, stored apart from its picture so that it can be replotted or queried without
+    evaluating any energy again.
+
+    ``C_grid[i, j]`` is the index into ``legend`` of the stable combination at ``temperature_array[i]`` and
+    ``pressure_array[j]``, -1 where none is in range; it is kept in the smallest integer type that fits. Each
+    entry of ``legend`` describes a combination as ``[coefficient, type, name]`` triples. ``boundaries`` are the
+    boundary lines of the diagram, as ``(first, second, polylines)`` with the legend indices of the two
+    combinations and ``(N, 2)`` arrays of (P, T) points, drawn with the ``boundary_options`` of the same index.
+    ``gibbs_free_energies``, when exported, are the energies
+    of all the combinations, shaped ``(len(legend), *C_grid.shape)``, NaN where a combination is out of range.
+
+    Files ending with ``.h5`` or ``.hdf5`` are written with ``h5py`` (an optional dependency), as chunked and
+    compressed datasets; anything else as a compressed ``.npz``.
+    '''
+
+    HDF5_SUFFIXES = ('.h5', '.hdf5')
+
+    pressure_array: numpy.ndarray
+    temperature_array: numpy.ndarray
+    C_grid: numpy.ndarray
+    legend: List[list]
+    boundaries: List[tuple]
+    boundary_options: List[dict]
+    gibbs_free_energies: Optional[numpy.ndarray]
+
+    # Boundary options that do not change the polylines
+    BOUNDARY_STYLE_OPTIONS = ('line_style', 'export', 'slopes')
+
+    def __init__(self, pressure_array, temperature_array, C_grid, legend: List[list], boundaries: List[tuple] = (), gibbs_free_energies=None, boundary_options: Optional[List[dict]] = None):
+        self.pressure_array = numpy.asarray(pressure_array, dtype='float64')
+        self.temperature_array = numpy.asarray(temperature_array, dtype='float64')
+        if numpy.shape(C_grid) != (len(self.temperature_array), len(self.pressure_array)):
+            raise RuntimeError("The phase map is {} but its axes are {} x {}".format(
+                ' x '.join(str(n) for n in numpy.shape(C_grid)), len(self.temperature_array), len(self.pressure_array)
+            ))
+        self.legend = [ [ list(term) for term in description ] for description in legend ]
+        self.C_grid = numpy.asarray(C_grid).astype(numpy.min_scalar_type(-max(len(self.legend), 1)))
+        self.boundaries = [ (int(first), int(second), [ numpy.asarray(polyline, dtype='float64') for polyline in polylines ]) for first, second, polylines in boundaries ]
+        self.gibbs_free_energies = None if gibbs_free_energies is None else numpy.asarray(gibbs_free_energies)
+        self.boundary_options = [ {} for _ in self.boundaries ] if boundary_options is None else list(boundary_options)
+
+    @classmethod
+    def boundary_key(cls, boundary_options: dict) -> str:
+        '''
+        The options of a boundary that its polylines depend on, comparable across saving and loading
+        '''
+        return json.dumps({ key: value for key, value in boundary_options.items() if key not in cls.BOUNDARY_STYLE_OPTIONS }, sort_keys=True, default=list)
+
+    @staticmethod
+    def describe(combination) -> list:
+        return [ [substance[0], substance[1].substance_type, substance[1].substance_name] for substance in combination.substances ]
+
+    @classmethod
+    def from_combinations(cls, pressure_array, temperature_array, C_grid, combinations: list, boundaries: List[tuple] = (), gibbs_free_energies=None, boundary_options: Optional[List[dict]] = None) -> 'PhaseMap':
+        '''
+        A phase map whose legend describes ``combinations``; the boundaries are given as ``(first, second,
+        polylines)`` with the combinations themselves.
+        '''
+        indices = { id(combination): k for k, combination in enumerate(combinations) }
+        return cls(
+            pressure_array, temperature_array, C_grid, [ cls.describe(combination) for combination in combinations ],
+            [ (indices[id(first)], indices[id(second)], polylines) for first, second, polylines in boundaries ],
+            gibbs_free_energies, boundary_options
+        )
+
+    def matches(self, combinations: list) -> bool:
+        '''
+        Whether the legend describes ``combinations``, in the same order.
+        '''
+        return self.legend == [ self.describe(combination) for combination in combinations ]
+
+    def legend_names(self) -> List[str]:
+        return [ ' + '.join(term[2] for term in description) for description in self.legend ]
+
+    def _boundary_arrays(self) -> dict:
+        # Polylines of all the boundaries end to end, with the offset of each and the boundary it belongs to
+        polylines = [ (k, polyline) for k, (_, _, boundary_polylines) in enumerate(self.boundaries) for polyline in boundary_polylines ]
+        return {
+            'boundary_combinations': numpy.array([ (first, second) for first, second, _ in self.boundaries ], dtype=numpy.int64).reshape(-1, 2),
+            'boundary_points': numpy.concatenate([ polyline for _, polyline in polylines ]) if polylines else numpy.empty((0, 2)),
+            'boundary_offsets': numpy.cumsum([0] + [ len(polyline) for _, polyline in polylines ]).astype(numpy.int64),
+            'boundary_index': numpy.array([ k for k, _ in polylines ], dtype=numpy.int64)
+        }
+
+    @staticmethod
+    def _boundaries_from_arrays(arrays: dict) -> List[tuple]:
+        offsets, index, points = arrays['boundary_offsets'], arrays['boundary_index'], arrays['boundary_points']
+        return [
+            (first, second, [ points[offsets[n]:offsets[n + 1]] for n in numpy.flatnonzero(index == k) ])
+            for k, (first, second) in enumerate(arrays['boundary_combinations'])
+        ]
+
+    def save(self, fname: str):
+        arrays = dict(
+            pressure_array=self.pressure_array, temperature_array=self.temperature_array, C_grid=self.C_grid,
+            **self._boundary_arrays()
+        )
+        if self.gibbs_free_energies is not None: arrays['gibbs_free_energies'] = self.gibbs_free_energies
+        legend = json.dumps(self.legend)
+        boundary_options = json.dumps([ json.loads(self.boundary_key(options)) for options in self.boundary_options ])
+
+        if os.path.splitext(fname)[1].lower() in self.HDF5_SUFFIXES:
+            if h5py is None:
+                raise RuntimeError("Writing {} needs h5py, which is not installed; export to .npz instead".format(fname))
+            with h5py.File(fname, 'w') as fp:
+                fp.attrs['legend'] = legend
+                fp.attrs['boundary_options'] = boundary_options
+                for name, array in arrays.items():
+                    chunked = array.ndim >= 2 and array.size > 0
+                    fp.create_dataset(name, data=array, chunks=True if chunked else None, compression='gzip' if chunked else None)
+        else:
+            numpy.savez_compressed(fname, legend=numpy.array(legend), boundary_options=numpy.array(boundary_options), **arrays)
+
+    @classmethod
+    def load(cls, fname: str) -> 'PhaseMap':
+        if os.path.splitext(fname)[1].lower() in cls.HDF5_SUFFIXES:
+            if h5py is None:
+                raise RuntimeError("Reading {} needs h5py, which is not installed".format(fname))
+            with h5py.File(fname, 'r') as fp:
+                legend = fp.attrs['legend']
+                boundary_options = fp.attrs.get('boundary_options')
+                arrays = { name: fp[name][()] for name in fp.keys() }
+        else:
+            with numpy.load(fname) as fp:
+                arrays = { name: fp[name] for name in fp.files }
+                legend = str(arrays.pop('legend'))
+                boundary_options = str(arrays.pop('boundary_options')) if 'boundary_options' in arrays else None
+
+        return cls(
+            arrays['pressure_array'], arrays['temperature_array'], arrays['C_grid'], json.loads(legend),
+            cls._boundaries_from_arrays(arrays), arrays.get('gibbs_free_energies'),
+            None if boundary_options is None else json.loads(boundary_options)
+        )
+
+    def stable_combinations(self, P, T) -> numpy.ndarray:
+        '''
+        Legend index of the stable combination at the node nearest to each point, -1 outside of the map.
+        '''
+        P, T = numpy.broadcast_arrays(numpy.asarray(P, dtype='float64'), numpy.asarray(T, dtype='float64'))
+        C = self.C_grid[AxisIndex(self.temperature_array).nearest(T), AxisIndex(self.pressure_array).nearest(P)].astype(int)
+        half_p = (self.pressure_array[1] - self.pressure_array[0]) / 2 if len(self.pressure_array) > 1 else 0
+        half_t = (self.temperature_array[1] - self.temperature_array[0]) / 2 if len(self.temperature_array) > 1 else 0
+        outside = (
+            (P < self.pressure_array[0] - half_p) | (P > self.pressure_array[-1] + half_p) |
+            (T < self.temperature_array[0] - half_t) | (T > self.temperature_array[-1] + half_t)
+        )
+        C[outside] = -1
+        return C
+
+    def query(self, P, T) -> tuple:
+        '''
+        Like ``stable_combinations``, along with the energy of the stable combination and the margin to the
+        runner-up at the nearest node (see ``GibbsFreeEnergyEvaluator.rank``), which are NaN unless the energies
+        were exported.
+        '''
+        C = self.stable_combinations(P, T)
+        if self.gibbs_free_energies is None:
+            return C, numpy.full(C.shape, numpy.nan), numpy.full(C.shape, numpy.nan)
+        P, T = numpy.broadcast_arrays(numpy.asarray(P, dtype='float64'), numpy.asarray(T, dtype='float64'))
+        G = self.gibbs_free_energies[:, AxisIndex(self.temperature_array).nearest(T), AxisIndex(self.pressure_array).nearest(P)]
+        _, G_min, margin = GibbsFreeEnergyEvaluator.rank(numpy.where(numpy.isnan(G), numpy.inf, G))
+        G_min[C < 0] = numpy.nan
+        margin[C < 0] = numpy.nan
+        return C, G_min, margin
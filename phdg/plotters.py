@@ -1,16 +1,29 @@
 from typing import List, Dict
 import copy
+import itertools
 
 import numpy
 import matplotlib
-from matplotlib import pyplot as plt
+import matplotlib.axes
+import matplotlib.figure
+import matplotlib.lines
+import matplotlib.patches
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 from abstract import System, Substance
+from instrument import get_logger, profiler
+
+logger = get_logger('plotters')
 
 class Plotter:
 
     type_keywords: List[str]
     default_options: dict
+    # Options the computed result depends on, for plotters that can save it and plot it back (``export`` and
+    # ``phase_map``); empty for the others
+    phase_map_options: List[str] = []
+    # Options naming files the plot reads
+    input_file_options: List[str] = []
 
     def __init__(self) -> None:
         pass
@@ -22,24 +35,46 @@ class Plotter:
                 options[key] = kwargs[key]
         return options
 
+    def get_evaluation_points(self, system: System, **kwargs) -> List[tuple]:
+        '''
+        The ``(combinations, P, T)`` grids on which the plot will evaluate the Gibbs free energies of
+        ``combinations``, so that ``PlotterManager`` can share the substance energies between plots. The points
+        must be computed exactly as ``plot`` does.
+        '''
+        return []
+
+    def get_dependencies(self, system: System, **kwargs) -> List[Substance]:
+        '''
+        The substances whose tables the plot depends on, all of them unless the plotter knows better.
+        '''
+        return system.substances
+
     def plot(self, system: System, output: str, **kwargs):
 
         options = self._load_kwargs(kwargs)
 
-def draw_rectangle(x, y, options: dict, text=""):
+def new_figure(**kwargs) -> matplotlib.figure.Figure:
+    '''
+    A figure on the non-interactive Agg canvas, independent of the global ``pyplot`` state
+    '''
+    fig = matplotlib.figure.Figure(**kwargs)
+    FigureCanvasAgg(fig)
+    return fig
+
+def draw_rectangle(ax: matplotlib.axes.Axes, x, y, options: dict, text=""):
     x_min, x_max = x
     y_min, y_max = y
-    #c = next(plt.gca().get_prop_cycle())
+    #c = next(ax.get_prop_cycle())
     #print(dir(c))
 
     c = numpy.random.random(3).tolist()
     fc = tuple(c + [.1])
     ec = tuple(c + [.7])
-    #line, = plt.plot((x_min, x_max, x_max, x_min, x_min), (y_min, y_min, y_max, y_max, y_min))
+    #line, = ax.plot((x_min, x_max, x_max, x_min, x_min), (y_min, y_min, y_max, y_max, y_min))
     rect = matplotlib.patches.Rectangle((x_min, y_min), -numpy.subtract(*x), -numpy.subtract(*y), facecolor=fc, edgecolor=ec)
-    plt.gca().add_patch(rect)
-    plt.text(x_max, y_max, text, ha='right', va='top', color=ec, fontsize="small")
-    plt.text(x_min, y_min, text, ha='left', va='bottom', color=ec, fontsize="small")
+    ax.add_patch(rect)
+    ax.text(x_max, y_max, text, ha='right', va='top', color=ec, fontsize="small")
+    ax.text(x_min, y_min, text, ha='left', va='bottom', color=ec, fontsize="small")
     return text, rect
 
 class SubstanceFieldPlotter(Plotter):
@@ -58,27 +93,29 @@ class SubstanceFieldPlotter(Plotter):
 
         options = self._load_kwargs(kwargs)
 
-        plt.figure()
+        fig = new_figure()
+        ax = fig.add_subplot()
 
-        print('We are working on the following phases:')
+        logger.info('We are working on the following phases:')
 
         for substance in system.substances:
 
-            print(' - {} with P in {} and T in {}'.format(substance, substance.get_pressure_range(), substance.get_temperature_range()))
+            logger.info(' - %s with P in %s and T in %s', substance, substance.get_pressure_range(), substance.get_temperature_range())
 
             p_range = substance.get_pressure_range()
             t_range = substance.get_temperature_range()
 
-            draw_rectangle(p_range, t_range, options, '{} ({})'.format(
+            draw_rectangle(ax, p_range, t_range, options, '{} ({})'.format(
                 substance.substance_type,
                 substance.substance_name)
             )
 
-        plt.xlim(*options['p_range'])
-        plt.ylim(*options['t_range'])
-        plt.xlabel('$P$ / GPa')
-        plt.ylabel('$T$ / K')
-        plt.savefig(output, dpi=300)
+        ax.set_xlim(*options['p_range'])
+        ax.set_ylim(*options['t_range'])
+        ax.set_xlabel('$P$ / GPa')
+        ax.set_ylabel('$T$ / K')
+        with profiler.timer('savefig'):
+            fig.savefig(output, dpi=300)
 
 class CombinationFieldPlotter(Plotter):
 
@@ -96,95 +133,163 @@ class CombinationFieldPlotter(Plotter):
 
         options = self._load_kwargs(kwargs)
 
-        plt.figure()
+        fig = new_figure()
+        ax = fig.add_subplot()
 
-        print('Possible combinations of phases are:')
+        logger.info('Possible combinations of phases are:')
 
         for combination in system.find_combinations():
 
-            print(' - {} with P in {} and T in {}'.format(combination, combination.get_pressure_range(), combination.get_temperature_range()))
+            logger.info(' - %s with P in %s and T in %s', combination, combination.get_pressure_range(), combination.get_temperature_range())
 
             p_range = combination.get_pressure_range()
             t_range = combination.get_temperature_range()
 
-            draw_rectangle(p_range, t_range, options)
+            draw_rectangle(ax, p_range, t_range, options)
 
-        plt.xlim(*options['p_range'])
-        plt.ylim(*options['t_range'])
-        plt.xlabel('$P$ / GPa')
-        plt.ylabel('$T$ / K')
-        plt.savefig(output, dpi=300)
+        ax.set_xlim(*options['p_range'])
+        ax.set_ylim(*options['t_range'])
+        ax.set_xlabel('$P$ / GPa')
+        ax.set_ylabel('$T$ / K')
+        with profiler.timer('savefig'):
+            fig.savefig(output, dpi=300)
 
 class GibbsDifferencePlotter(Plotter):
+    '''
+    Gibbs free energy of every combination relative to the ``base`` one, against pressure, at temperatures
+    every ``t_step``.
+
+    By default every combination is evaluated along its own pressure range, together with the base. With
+    ``sweep: true``, all the combinations are evaluated at once over the common ``p_step`` x ``t_step`` grid and
+    the lines are drawn from that tensor (see ``sweep``); where a combination or the base is out of range, the
+    line is left out.
+    '''
 
     type_keywords: List[str] = [ "gibbs_free_energy_difference" ]
     default_options: dict = {
         "p_range": [-5, 500],
+        "p_step": 1,
         "t_range": [0, 3000],
         "t_step": 300,
-        "base": 0
+        "base": 0,
+        "sweep": False
     }
 
     def __init__(self) -> None:
         super().__init__()
 
 
+    def find_combinations(self, system: System, options: dict) -> list:
+        p_range = options['p_range']
+        return [
+            combination for combination in system.find_combinations()
+            if (not combination.get_pressure_range()[1] < p_range[0]) and (not combination.get_pressure_range()[0] > p_range[1])
+        ]
+
+    def get_pressure_array(self, combination, options: dict) -> numpy.ndarray:
+        p_min, p_max = combination.get_pressure_range()
+        return numpy.arange(max(p_min, options['p_range'][0]), min(p_max, options['p_range'][1]), options['p_step'])
+
+    def get_temperature_array(self, options: dict) -> numpy.ndarray:
+        return numpy.arange(options['t_range'][0], options['t_range'][1], options['t_step'])
+
+    def get_dependencies(self, system: System, **kwargs) -> List[Substance]:
+        options = self._load_kwargs(kwargs)
+        return list({ id(substance[1]): substance[1] for combination in self.find_combinations(system, options) for substance in combination.substances }.values())
+
+    def get_sweep_axes(self, options: dict) -> tuple:
+        '''
+        ``(p_array, t_array)`` of the grid of the sweep mode
+        '''
+        return numpy.arange(options['p_range'][0], options['p_range'][1], options['p_step']), self.get_temperature_array(options)
+
+    def sweep(self, system: System, combinations: list, base_idx: int, p_array: numpy.ndarray, t_array: numpy.ndarray) -> numpy.ndarray:
+        '''
+        Gibbs free energy of each of ``combinations`` minus that of ``combinations[base_idx]`` over the
+        ``t_array`` x ``p_array`` grid, shaped ``(combination, T, P)``, NaN where either is out of range. All the
+        combinations, the base included, are evaluated in a single batched call.
+        '''
+        P, T = numpy.meshgrid(p_array, t_array)
+        evaluator = system.get_evaluator(combinations)
+        G = evaluator.gibbs_free_energies(P, T)
+        G[~evaluator.range_mask(P, T)] = numpy.nan
+        return G - G[base_idx]
+
+    def get_evaluation_points(self, system: System, **kwargs) -> List[tuple]:
+        options = self._load_kwargs(kwargs)
+        combinations = self.find_combinations(system, options)
+        if not isinstance(options['base'], int): return []
+        if options['sweep']:
+            return [ (combinations, *numpy.meshgrid(*self.get_sweep_axes(options))) ]
+        points = []
+        for combination in combinations:
+            t_min, t_max = combination.get_temperature_range()
+            p_array = self.get_pressure_array(combination, options)
+            if len(p_array) == 0: continue
+            points.extend(
+                ([combination, combinations[options['base']]], p_array, t) for t in self.get_temperature_array(options)
+                if not (t > t_max or t < t_min)
+            )
+        return points
+
     def plot(self, system: System, output: str, **kwargs):
 
         options = self._load_kwargs(kwargs)
 
-        plt.figure(figsize=(9, 6))
+        fig = new_figure(figsize=(9, 6))
+        ax = fig.add_subplot()
 
-        p_range = options['p_range']
-        
-        combinations = [
-            combination for combination in system.find_combinations()
-            if (not combination.get_pressure_range()[1] < p_range[0]) and (not combination.get_pressure_range()[0] > p_range[1])
-        ]
+        combinations = self.find_combinations(system, options)
         
         if isinstance(options['base'], int):
             base_idx = options['base']
         else:
             raise NotImplementedError()
 
+        if options['sweep']:
+            p_array, t_array = self.get_sweep_axes(options)
+            differences = self.sweep(system, combinations, base_idx, p_array, t_array)
+            self.draw(fig, ax, combinations, p_array, differences, [ "$T$ = {} K".format(t) for t in t_array ], '$P$ / GPa')
+            with profiler.timer('savefig'):
+                fig.savefig(output, dpi=300)
+            return
+
         line_style_keys = list(matplotlib.lines.lineStyles.keys())[:4] * 3
 
         linestyle_iter = iter(line_style_keys)
 
-        t_array = numpy.arange(options['t_range'][0], options['t_range'][1], options['t_step'])
+        t_array = self.get_temperature_array(options)
 
         from palettable.cartocolors.qualitative import Prism_10
         from cycler import cycler
 
         for combination in combinations:
 
-            print(' - {} with P in {} and T in {}'.format(combination, combination.get_pressure_range(), combination.get_temperature_range()))
+            logger.info(' - %s with P in %s and T in %s', combination, combination.get_pressure_range(), combination.get_temperature_range())
 
             line_style = next(linestyle_iter)
 
             t_min, t_max = combination.get_temperature_range()
-            p_min, p_max = combination.get_pressure_range()
 
-            p_array = numpy.arange(max(p_min, p_range[0]), min(p_max, p_range[1]), 1)
+            p_array = self.get_pressure_array(combination, options)
             if len(p_array.tolist()) == 0: continue
 
+            evaluator = system.get_evaluator([combination, combinations[base_idx]])
 
-
-            ax = plt.gca()
             ax.set_prop_cycle(cycler('color', Prism_10.mpl_colors))
 
 
             for t in t_array:
                 if t > t_max or t < t_min: continue
                 name = ' + '.join(s[1].substance_name for s in combination.substances)
-                plt.plot(
+                ax.plot(
                     p_array,
-                    combination.get_gibbs_free_energy_unsafe(p_array, t) - combinations[base_idx].get_gibbs_free_energy_unsafe(p_array, t),
+                    numpy.subtract(*evaluator.gibbs_free_energies(p_array, t)),
                     label="{} at {} K".format(name, t),
                     linestyle=line_style
                 )
             
-        plt.gca().legend([
+        ax.legend([
             matplotlib.lines.Line2D([0], [0], color=c)
             for (t, c) in zip(t_array, Prism_10.mpl_colors[:len(t_array)])
         ] + [
@@ -194,8 +299,79 @@ class GibbsDifferencePlotter(Plotter):
             ' + '.join(s[1].substance_name for s in combination.substances)
             for combination in combinations
         ], bbox_to_anchor=(1.04, .5), loc="center left")
-        plt.xlabel('$P$ / GPa')
-        plt.ylabel(r'$\Delta G$ / Ryd')
-        plt.tight_layout(rect=[0, 0, 0.8, 1])
-        plt.savefig(output, dpi=300)
+        ax.set_xlabel('$P$ / GPa')
+        ax.set_ylabel(r'$\Delta G$ / Ryd')
+        fig.tight_layout(rect=[0, 0, 0.8, 1])
+        with profiler.timer('savefig'):
+            fig.savefig(output, dpi=300)
+
+    def draw(self, fig: matplotlib.figure.Figure, ax: matplotlib.axes.Axes, combinations: list, x: numpy.ndarray, curves: numpy.ndarray, slice_labels: List[str], xlabel: str):
+        '''
+        Draw ``curves[k, i]`` against ``x`` for every combination ``k`` (one line style each) and every slice
+        ``i`` (one colour each), leaving out the slices where a combination has no value.
+        '''
+        from palettable.cartocolors.qualitative import Prism_10
+
+        line_style_keys = list(matplotlib.lines.lineStyles.keys())[:4] * 3
+        colors = [ Prism_10.mpl_colors[i % len(Prism_10.mpl_colors)] for i in range(len(slice_labels)) ]
+
+        for combination, line_style, combination_curves in zip(combinations, itertools.cycle(line_style_keys), curves):
+            logger.info(' - %s with P in %s and T in %s', combination, combination.get_pressure_range(), combination.get_temperature_range())
+            name = ' + '.join(s[1].substance_name for s in combination.substances)
+            for color, label, curve in zip(colors, slice_labels, combination_curves):
+                if numpy.all(numpy.isnan(curve)): continue
+                ax.plot(x, curve, color=color, label="{} at {}".format(name, label), linestyle=line_style)
+
+        ax.legend([
+            matplotlib.lines.Line2D([0], [0], color=c) for c in colors
+        ] + [
+            matplotlib.lines.Line2D([0], [0], linestyle=s, c='k')
+            for (c, s) in zip(combinations, itertools.cycle(line_style_keys))
+        ], slice_labels + [
+            ' + '.join(s[1].substance_name for s in combination.substances)
+            for combination in combinations
+        ], bbox_to_anchor=(1.04, .5), loc="center left")
+        ax.set_xlabel(xlabel)
+        ax.set_ylabel(r'$\Delta G$ / Ryd')
+        fig.tight_layout(rect=[0, 0, 0.8, 1])
+
+class GibbsDifferenceIsobaricPlotter(GibbsDifferencePlotter):
+    '''
+    The isobaric counterpart of ``GibbsDifferencePlotter``: the Gibbs free energy of every combination
+    relative to the ``base`` one against temperature (every ``t_step``), at pressures every ``p_step``,
+    computed by the same batched ``sweep``.
+    '''
+
+    type_keywords: List[str] = [ "gibbs_free_energy_difference_isobaric" ]
+    default_options: dict = {
+        "p_range": [-5, 500],
+        "p_step": 50,
+        "t_range": [0, 3000],
+        "t_step": 10,
+        "base": 0
+    }
+
+    def get_evaluation_points(self, system: System, **kwargs) -> List[tuple]:
+        options = self._load_kwargs(kwargs)
+        if not isinstance(options['base'], int): return []
+        return [ (self.find_combinations(system, options), *numpy.meshgrid(*self.get_sweep_axes(options))) ]
+
+    def plot(self, system: System, output: str, **kwargs):
+
+        options = self._load_kwargs(kwargs)
+
+        if not isinstance(options['base'], int):
+            raise RuntimeError("base must be the integer index of a combination")
+
+        fig = new_figure(figsize=(9, 6))
+        ax = fig.add_subplot()
+
+        combinations = self.find_combinations(system, options)
+        p_array, t_array = self.get_sweep_axes(options)
+        differences = self.sweep(system, combinations, options['base'], p_array, t_array)
+
+        # Slices along pressure
+        self.draw(fig, ax, combinations, t_array, differences.transpose(0, 2, 1), [ "$P$ = {} GPa".format(p) for p in p_array ], '$T$ / K')
+        with profiler.timer('savefig'):
+            fig.savefig(output, dpi=300)
 
@@ -1,15 +1,162 @@
+from typing import Optional
+import itertools
+import warnings
+
+import numpy
+
 from gibbs import GibbsFreeEnergyGrid
+from cache import GibbsFreeEnergyGridCache, GibbsFreeEnergyGridMemoryCache
+from instrument import get_logger, profiler
+
+logger = get_logger('reader')
 
 class GibbsFreeEnergyGridTableReader:
+    '''
+    Reads Gibbs free energy tables, going through a ``GibbsFreeEnergyGridCache`` when one is given.
+    With ``rebuild``, cached entries are ignored and overwritten by freshly parsed tables. With a
+    ``memory_cache``, the grids read are also kept in memory and handed out again to later readers sharing it.
+
+    Tables are parsed by one of the ``BACKENDS``:
+
+    - ``streaming``: counts the rows first, then parses the body block by block straight into preallocated
+      arrays, so the peak memory is the table itself plus one block of ``block_size`` bytes;
+    - ``loadtxt``: hands the whole body to ``numpy.loadtxt`` at once.
+    '''
+
+    BACKENDS = ('streaming', 'loadtxt')
+
+    cache: Optional[GibbsFreeEnergyGridCache]
+    memory_cache: Optional[GibbsFreeEnergyGridMemoryCache]
+    rebuild: bool
+    backend: str
+    block_size: int
+
+    def __init__(self, cache: Optional[GibbsFreeEnergyGridCache] = None, rebuild: bool = False, backend: str = 'streaming', block_size: int = 1 << 22, memory_cache: Optional[GibbsFreeEnergyGridMemoryCache] = None):
+        if backend not in self.BACKENDS:
+            raise RuntimeError("Unknown table reader backend {}, expected one of {}".format(backend, ', '.join(self.BACKENDS)))
+        self.cache = cache
+        self.memory_cache = memory_cache
+        self.rebuild = rebuild
+        self.backend = backend
+        self.block_size = block_size
+
     @staticmethod
     def load_table_from_file(fname: str):
         with open(fname) as fp:
             row_index = numpy.array(fp.readline().split()[1:], dtype='float64')
-            main_area = numpy.loadtxt(fp, dtype='float64')
+            main_area = numpy.loadtxt(fp, dtype='float64', ndmin=2)
             col_index = main_area[:, 0]
             data = main_area[:, 1:]
         return row_index, col_index, data
-    
+
     @staticmethod
-    def read_gibbs_free_energy(fname: str):
-        return GibbsFreeEnergyGrid(*GibbsFreeEnergyGrid.load_table_from_file(fname))
\ No newline at end of file
+    def stream_table_from_file(fname: str, block_size: int = 1 << 22):
+        with open(fname, 'rb') as fp:
+            header = fp.readline()
+            num_rows = 0
+            last = b'\n'
+            for block in iter(lambda: fp.read(block_size), b''):
+                num_rows += block.count(b'\n')
+                last = block[-1:]
+            if last != b'\n': num_rows += 1
+
+        row_index = numpy.array(header.split()[1:], dtype='float64')
+        col_index = numpy.empty(num_rows, dtype='float64')
+        data = numpy.empty((num_rows, len(row_index)), dtype='float64')
+
+        # Rows are about as long as the header
+        rows_per_block = max(1, block_size // max(len(header), 1))
+        row = 0
+
+        with open(fname) as fp:
+            fp.readline()
+            while True:
+                lines = list(itertools.islice(fp, rows_per_block))
+                if len(lines) == 0: break
+                with warnings.catch_warnings():
+                    # Blocks made of blank lines only are fine
+                    warnings.simplefilter('ignore', UserWarning)
+                    try:
+                        block = numpy.loadtxt(lines, dtype='float64', ndmin=2)
+                    except ValueError as e:
+                        raise RuntimeError('{}: malformed table near data row {}: {}'.format(fname, row + 1, e))
+                if block.size == 0: continue
+                if block.shape[1] != len(row_index) + 1:
+                    raise RuntimeError('{}: data row {} has {} pressure columns, the header has {}'.format(
+                        fname, row + 1, block.shape[1] - 1, len(row_index)
+                    ))
+                col_index[row:row + len(block)] = block[:, 0]
+                data[row:row + len(block)] = block[:, 1:]
+                row += len(block)
+
+        return row_index, col_index[:row], data[:row]
+
+    @staticmethod
+    def scan_axes_from_file(fname: str):
+        '''
+        Read the pressure axis (header row) and the temperature axis (first column) without parsing the data.
+        '''
+        with open(fname, 'rb') as fp:
+            row_index = numpy.array(fp.readline().split()[1:], dtype='float64')
+            col_index = []
+            for line in fp:
+                tokens = line.split(None, 1)
+                if len(tokens) == 0 or tokens[0].startswith(b'#'): continue
+                col_index.append(float(tokens[0]))
+        return row_index, numpy.array(col_index, dtype='float64')
+
+    @staticmethod
+    def check_axes(fname: str, row_index: numpy.ndarray, col_index: numpy.ndarray):
+        if len(row_index) == 0:
+            raise RuntimeError('{}: the header has no pressure columns'.format(fname))
+        if len(col_index) == 0:
+            raise RuntimeError('{}: the table has no data rows'.format(fname))
+
+    def parse_table(self, fname: str):
+        if self.backend == 'streaming':
+            row_index, col_index, data = self.stream_table_from_file(fname, self.block_size)
+        else:
+            row_index, col_index, data = self.load_table_from_file(fname)
+        self.check_axes(fname, row_index, col_index)
+        if data.ndim != 2 or data.shape != (len(col_index), len(row_index)):
+            raise RuntimeError('{}: the header has {} pressure columns but the data is {}'.format(
+                fname, len(row_index), ' x '.join(str(n) for n in data.shape)
+            ))
+        return row_index, col_index, data
+
+    def load_table(self, fname: str):
+        with profiler.timer('load table'):
+            if self.cache is not None and not self.rebuild:
+                table = self.cache.load(fname)
+                if table is not None:
+                    logger.debug('%s read from the cache', fname)
+                    profiler.count('tables from cache')
+                    return table
+            logger.debug('parsing %s', fname)
+            profiler.count('tables parsed')
+            with profiler.timer('parse table'):
+                table = self.parse_table(fname)
+            if self.cache is not None: self.cache.store(fname, *table)
+            return table
+
+    def load_axes(self, fname: str):
+        '''
+        ``(pressure, temperature)`` axes of a table, from the caches when possible, otherwise from a header scan.
+        '''
+        with profiler.timer('load axes'):
+            if self.memory_cache is not None:
+                axes = self.memory_cache.axes(fname)
+                if axes is not None: return axes
+            if self.cache is not None and not self.rebuild:
+                table = self.cache.load(fname)
+                if table is not None: return table[0], table[1]
+            row_index, col_index = self.scan_axes_from_file(fname)
+            self.check_axes(fname, row_index, col_index)
+            return row_index, col_index
+
+    def read_gibbs_free_energy(self, fname: str, interpolation: str = 'nearest'):
+        if self.memory_cache is not None:
+            return self.memory_cache.load(
+                fname, interpolation, lambda: GibbsFreeEnergyGrid(*self.load_table(fname), interpolation=interpolation)
+            )
+        return GibbsFreeEnergyGrid(*self.load_table(fname), interpolation=interpolation)